@@ -0,0 +1,137 @@
+# app/core/admission.py
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict
+
+from app.core.metrics import ADMISSION_WAIT
+
+
+class AdmissionRejected(Exception):
+    """并发已满且等待队列已满 (或排队超时)，调用方应返回 429。"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionSlot:
+    """一个并发名额，release() 可重复调用，只生效一次。"""
+
+    __slots__ = ("controller", "released")
+
+    def __init__(self, controller: "AdmissionController"):
+        self.controller = controller
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release()
+
+
+class AdmissionController:
+    """
+    流式请求的准入控制。
+    同时进行的流不超过 max_concurrent 个，超出的请求按 key (API Key / 会话) 分队列等待，
+    名额空出时在各 key 之间轮转分配，单个 key 的突发请求不会饿死其他 key。
+    每个 key 最多占用队列的公平份额 (max_queue // 排队中的 key 数，max_queue_per_key > 0 时再以其为上限)，
+    超出份额的请求立即拒绝；队列已满时新 key 的请求挤掉排队最多的 key 的最新请求，只有超出份额的 key 收到 429。
+    等待超过 queue_timeout 秒同样拒绝。max_concurrent <= 0 表示不限制。
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float, max_queue_per_key: int = 0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_key = max_queue_per_key
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self.queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    def _retry_after(self) -> int:
+        if self.max_concurrent <= 0: return 1
+        return max(1, math.ceil((self.queued + 1) / self.max_concurrent))
+
+    def _share(self, key: str) -> int:
+        keys = len(self.queues) + (key not in self.queues)
+        share = max(1, self.max_queue // keys)
+        return min(share, self.max_queue_per_key) if self.max_queue_per_key > 0 else share
+
+    def _evict_longest(self, depth: int) -> bool:
+        """队列已满时，从排队最多的 key 中拒绝其最新的请求，为排队更少的 key 腾出位置。"""
+        key, queue = max(self.queues.items(), key=lambda item: len(item[1]))
+        if len(queue) <= depth + 1: return False
+        waiter = queue.pop()
+        self.queued -= 1
+        self.rejected += 1
+        waiter.set_exception(AdmissionRejected("该 API Key / 会话排队的请求过多，请稍后重试。", self._retry_after()))
+        return True
+
+    async def acquire(self, key: str) -> AdmissionSlot:
+        if self.max_concurrent <= 0 or (self.active < self.max_concurrent and not self.queued):
+            self.active += 1
+            ADMISSION_WAIT.observe(0)
+            return AdmissionSlot(self)
+        queue = self.queues.get(key)
+        depth = len(queue) if queue else 0
+        if depth >= self._share(key):
+            self.rejected += 1
+            raise AdmissionRejected("该 API Key / 会话排队的请求过多，请稍后重试。", self._retry_after())
+        if self.queued >= self.max_queue and (self.max_queue <= 0 or not self._evict_longest(depth)):
+            self.rejected += 1
+            raise AdmissionRejected("并发请求过多，请稍后重试。", self._retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(key, deque()).append(waiter)
+        self.queued += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except BaseException as e:
+            if isinstance(e, AdmissionRejected):
+                # 队列满时被排队更少的 key 挤出，已从队列中移除
+                raise
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # 名额已经转交给本请求，但请求随即被取消或超时，把名额交还
+                self._release()
+            else:
+                waiter.cancel()
+                self._discard(key, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise AdmissionRejected("排队等待超时，请稍后重试。", self._retry_after())
+            raise
+        ADMISSION_WAIT.observe(time.perf_counter() - started)
+        return AdmissionSlot(self)
+
+    def _discard(self, key: str, waiter: asyncio.Future):
+        queue = self.queues.get(key)
+        if queue is None: return
+        try:
+            queue.remove(waiter)
+            self.queued -= 1
+        except ValueError:
+            return
+        if not queue:
+            del self.queues[key]
+
+    def _release(self):
+        # 名额直接转交给下一个 key 的队首请求，active 不变；没有等待者时才真正释放
+        while self.queues:
+            key, queue = next(iter(self.queues.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self.queues.move_to_end(key)
+            else:
+                del self.queues[key]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"active": self.active, "queued": self.queued, "rejected": self.rejected, "limit": self.max_concurrent}
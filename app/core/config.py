@@ -15,9 +15,74 @@ class Settings(BaseSettings):
 
     API_MASTER_KEY: Optional[str] = "1"
     
+    # 上游地址，压测时可指向 benchmarks/fake_upstream.py 提供的本地替身
+    MYMAP_BASE_URL: str = "https://www.mymap.ai"
     API_REQUEST_TIMEOUT: int = 180
     NGINX_PORT: int = 8088
     SESSION_CACHE_TTL: int = 3600 # 会话缓存1小时
+    SESSION_CACHE_MAXSIZE: int = 1024
+    # 未提供 user 时的前缀索引 (每轮两条)，memory 后端下与会话分开计算容量，避免挤掉 user 会话
+    PREFIX_INDEX_MAXSIZE: int = 4096
+
+    # 会话存储后端: memory (单 worker) / sqlite (同主机多 worker) / redis (多副本)
+    SESSION_BACKEND: str = "memory"
+    SESSION_SQLITE_PATH: str = "data/sessions.db"
+    SESSION_REDIS_URL: str = "redis://127.0.0.1:6379/0"
+
+    # 上游连接: 身份数 (每个身份独立的 X-Distinct-Id 与 HTTP/2 连接池)、每个身份的连接上限、重试与熔断
+    UPSTREAM_IDENTITIES: int = 4
+    UPSTREAM_MAX_CONNECTIONS: int = 50
+    UPSTREAM_MAX_KEEPALIVE: int = 10
+    UPSTREAM_KEEPALIVE_EXPIRY: float = 30.0
+    UPSTREAM_CONNECT_TIMEOUT: float = 10.0
+    UPSTREAM_WARMUP: bool = True # 启动时为每个身份预先建立连接
+    UPSTREAM_RETRIES: int = 2 # 首个字节前失败 (连接错误 / 429 / 5xx) 的重试次数
+    UPSTREAM_BACKOFF_BASE: float = 0.5
+    UPSTREAM_BACKOFF_MAX: float = 8.0
+    UPSTREAM_BREAKER_THRESHOLD: int = 3 # 同一身份连续失败该次数后熔断
+    UPSTREAM_BREAKER_COOLDOWN: float = 30.0
+
+    # 上传缓存: 相同文件 (按内容哈希，远程文件按 URL + ETag / Last-Modified 条件请求校验) 在 TTL 内只上传一次
+    UPLOAD_CACHE_TTL: int = 3600
+    UPLOAD_CACHE_MAXSIZE: int = 512
+    # 单个请求内并发上传的文件数，以及下载 / S3 上传连接池的大小与超时 (秒)
+    UPLOAD_CONCURRENCY: int = 4
+    UPLOAD_MAX_CONNECTIONS: int = 20
+    UPLOAD_TIMEOUT: int = 60
+    # 流式上传: 单个文件的大小上限 (字节) 与转发时的块大小
+    UPLOAD_MAX_BYTES: int = 50 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 64 * 1024
+    # 源站未给出 Content-Length 时先写入临时文件以得到长度，不超过该大小时留在内存
+    UPLOAD_SPOOL_MEMORY_BYTES: int = 1024 * 1024
+    # 预签名 URL 池: 后台为常见类型预取上传 URL，每种类型最多保留 SIGNED_URL_POOL_MAX 个，0 表示禁用
+    SIGNED_URL_POOL_TYPES: List[str] = ["image/png", "image/jpeg", "image/webp", "application/pdf"]
+    SIGNED_URL_POOL_MAX: int = 4
+    SIGNED_URL_TTL: int = 600 # URL 中不含过期信息时假定的有效期 (秒)
+    SIGNED_URL_EXPIRY_MARGIN: int = 60 # 剩余有效期不足该秒数的 URL 不再使用
+
+    # 图表渲染: 按 visual XML 哈希缓存渲染好的 HTML 的条目数，0 表示不缓存
+    VISUAL_CACHE_MAXSIZE: int = 256
+    # 渲染执行器: thread (默认) / process (CPU 密集的大图表) / inline (在事件循环内同步渲染)
+    VISUAL_RENDER_EXECUTOR: str = "thread"
+    VISUAL_RENDER_WORKERS: int = 2
+    VISUAL_RENDER_TIMEOUT: float = 5.0 # 单个图表的渲染时间预算 (秒)，超时输出原始 XML
+    VISUAL_MAX_XML_BYTES: int = 1024 * 1024 # 超过该大小的 visual 块不渲染，直接输出原始 XML
+
+    # 准入控制: 每个 worker 同时进行的流数上限 (0 表示不限制)、等待队列长度与最长排队时间 (秒)，队列满时直接返回 429
+    MAX_CONCURRENT_STREAMS: int = 64
+    STREAM_QUEUE_SIZE: int = 128
+    STREAM_QUEUE_TIMEOUT: float = 30.0
+    STREAM_QUEUE_PER_KEY: int = 0 # 单个 API Key / 会话最多排队的请求数，0 表示按排队中的 key 数均分队列
+    # 可信反向代理的地址 / 网段：来自这些地址的请求按 X-Real-IP / X-Forwarded-For 识别客户端 (默认覆盖 docker 内网)
+    TRUSTED_PROXY_IPS: List[str] = ["127.0.0.1", "::1", "10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16"]
+
+    # SSE 合并: 在时间窗口 (毫秒) 内到达的上游块合并为一个 SSE 事件，0 表示不合并
+    SSE_COALESCE_DELAY_MS: int = 0
+    SSE_COALESCE_MAX_CHARS: int = 1024
+
+    # Web UI 静态文件: 启动时读入内存并预压缩；后台每隔 STATIC_RELOAD_INTERVAL 秒检查文件变化 (0 表示不检查)
+    STATIC_MAX_AGE: int = 3600 # script.js / style.css 的 Cache-Control max-age (秒)，index.html 始终重新验证
+    STATIC_RELOAD_INTERVAL: float = 2.0
 
     # 模型配置
     DEFAULT_MODEL: str = "mymap-ai"
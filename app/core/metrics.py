@@ -0,0 +1,183 @@
+# app/core/metrics.py
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# 指标只在事件循环线程中更新，单线程下普通的整数/浮点运算即可，热路径上不加锁
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"): return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels: return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def collect(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter", f"{self.name} {_format_value(self.value)}"]
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def collect(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {_format_value(self.value)}"]
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("series", "start")
+
+    def __init__(self, series: _HistogramSeries):
+        self.series = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.series.observe(time.perf_counter() - self.start)
+
+
+class Histogram:
+    """固定桶直方图；带 labelnames 时通过 labels(...) 取得各标签组合的子序列。"""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self.series: Dict[Tuple[str, ...], _HistogramSeries] = {}
+        if not labelnames:
+            self._default = self.series[()] = _HistogramSeries(self.buckets)
+
+    def labels(self, *values: str) -> _HistogramSeries:
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = _HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self) -> _Timer:
+        return _Timer(self._default)
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, series in self.series.items():
+            labels = dict(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(bound)})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {series.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    指标注册表，render() 输出 Prometheus 文本格式。
+    除直接注册的指标外，还可以注册回调，在抓取时从各组件的 stats() 读取数值作为 gauge 输出。
+    """
+
+    def __init__(self):
+        self.metrics: List = []
+        self.collectors: List[Tuple[str, str, Callable[[], Iterable[Tuple[Dict[str, str], float]]]]] = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        metric = Gauge(name, documentation)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        metric = Histogram(name, documentation, buckets, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, name: str, documentation: str, collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+        self.collectors = [collector for collector in self.collectors if collector[0] != name]
+        self.collectors.append((name, documentation, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        for name, documentation, collect in self.collectors:
+            lines += (f"# HELP {name} {documentation}", f"# TYPE {name} gauge")
+            lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for labels, value in collect())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+UPSTREAM_TTFB = registry.histogram("mymap_upstream_ttfb_seconds", "从发起上游请求到收到首个响应字节的时间")
+UPSTREAM_STREAM_DURATION = registry.histogram("mymap_upstream_stream_duration_seconds", "上游流式响应的总时长")
+CLIENT_TTFB = registry.histogram("mymap_client_ttfb_seconds", "从收到客户端请求到输出首个 SSE 事件的时间")
+STREAM_CHUNKS = registry.histogram("mymap_stream_chunks", "每个流输出的 SSE 事件数", COUNT_BUCKETS)
+STREAM_BYTES = registry.histogram("mymap_stream_bytes", "每个流输出的字节数", SIZE_BUCKETS)
+STREAMS_IN_FLIGHT = registry.gauge("mymap_streams_in_flight", "正在进行中的流式响应数")
+STREAM_ERRORS = registry.counter("mymap_stream_errors_total", "以错误结束的流式响应数")
+STREAMS_CANCELLED = registry.counter("mymap_streams_cancelled_total", "因客户端断开而提前取消的流式响应数")
+ADMISSION_WAIT = registry.histogram("mymap_admission_wait_seconds", "请求在准入队列中等待并发名额的时间")
+CONVERT_DURATION = registry.histogram("mymap_convert_duration_seconds", "OpenAI 消息转换 (含文件上传) 耗时")
+UPLOAD_STAGE_DURATION = registry.histogram("mymap_upload_stage_duration_seconds", "文件上传各阶段耗时", labelnames=("stage",))
+RENDER_DURATION = registry.histogram("mymap_render_duration_seconds", "visual 图表渲染耗时 (不含缓存命中)")
+SESSION_CACHE_HITS = registry.counter("mymap_session_cache_hits_total", "会话查询命中次数")
+SESSION_CACHE_MISSES = registry.counter("mymap_session_cache_misses_total", "会话查询未命中次数")
+PREFIX_INDEX_HITS = registry.counter("mymap_prefix_index_hits_total", "未提供 user 时按消息前缀找到可续用上游会话的次数")
+PREFIX_INDEX_MISSES = registry.counter("mymap_prefix_index_misses_total", "未提供 user 时按消息前缀未找到可续用上游会话的次数")
+SESSION_CACHE_EVICTIONS = registry.counter("mymap_session_cache_evictions_total", "内存会话缓存因过期或容量淘汰的条目数 (sqlite/redis 后端由存储自身过期)")
+PREFIX_INDEX_EVICTIONS = registry.counter("mymap_prefix_index_evictions_total", "内存前缀索引因过期或容量淘汰的条目数 (sqlite/redis 后端与会话共用存储)")
@@ -0,0 +1,298 @@
+# app/core/session_store.py
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlparse
+
+from cachetools import TTLCache
+
+from app.core.metrics import Counter, SESSION_CACHE_EVICTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class _EvictionCountingTTLCache(TTLCache):
+    """记录因过期或容量不足被淘汰的条目数的 TTLCache。"""
+
+    def __init__(self, maxsize: int, ttl: int, evictions: Counter):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.evictions = evictions
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.evictions.inc(len(expired or ()))
+        return expired
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions.inc()
+        return item
+
+
+class BaseSessionStore(ABC):
+    """会话存储后端：按 session_key 保存 chat_id / board_id 等会话信息，并按 TTL 淘汰。"""
+
+    @abstractmethod
+    async def get(self, session_key: str) -> Dict[str, Any]:
+        pass
+
+    @abstractmethod
+    async def update(self, session_key: str, data: Dict[str, Any]):
+        pass
+
+    async def get_many(self, session_keys: List[str]) -> List[Dict[str, Any]]:
+        """批量查询，结果与 session_keys 一一对应；子类应在一次后端往返内完成。"""
+        return [await self.get(session_key) for session_key in session_keys]
+
+    async def close(self):
+        pass
+
+
+class MemorySessionStore(BaseSessionStore):
+    """进程内 TTLCache，仅适用于单 worker 部署（默认后端）。"""
+
+    def __init__(self, ttl: int, maxsize: int = 1024, evictions: Counter = SESSION_CACHE_EVICTIONS):
+        self.cache = _EvictionCountingTTLCache(maxsize=maxsize, ttl=ttl, evictions=evictions)
+        self.lock = asyncio.Lock()
+
+    async def get(self, session_key: str) -> Dict[str, Any]:
+        async with self.lock:
+            return dict(self.cache.get(session_key, {}))
+
+    async def get_many(self, session_keys: List[str]) -> List[Dict[str, Any]]:
+        async with self.lock:
+            return [dict(self.cache.get(session_key, {})) for session_key in session_keys]
+
+    async def update(self, session_key: str, data: Dict[str, Any]):
+        async with self.lock:
+            session_data = dict(self.cache.get(session_key, {}))
+            session_data.update(data)
+            self.cache[session_key] = session_data
+
+
+class SQLiteSessionStore(BaseSessionStore):
+    """
+    基于 SQLite WAL 的跨进程会话存储，适用于同一主机上的多个 uvicorn worker。
+    数据库操作在线程池中执行，避免阻塞事件循环；跨进程的写入由 SQLite 事务保证原子性。
+    """
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self.lock = asyncio.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory: os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+            self._conn = conn
+        return self._conn
+
+    def _get_sync(self, session_key: str) -> Dict[str, Any]:
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE key = ? AND expires_at > ?", (session_key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _get_many_sync(self, session_keys: List[str]) -> List[Dict[str, Any]]:
+        if not session_keys: return []
+        rows = self._connection().execute(
+            f"SELECT key, data FROM sessions WHERE key IN ({','.join('?' * len(session_keys))}) AND expires_at > ?",
+            (*session_keys, time.time())
+        ).fetchall()
+        found = {key: json.loads(data) for key, data in rows}
+        return [found.get(session_key, {}) for session_key in session_keys]
+
+    def _update_sync(self, session_key: str, data: Dict[str, Any]):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM sessions WHERE key = ? AND expires_at > ?", (session_key, now)).fetchone()
+            session_data = json.loads(row[0]) if row else {}
+            session_data.update(data)
+            conn.execute(
+                "INSERT INTO sessions (key, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (session_key, json.dumps(session_data), now + self.ttl),
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def _run(self, func, *args):
+        async with self.lock:
+            future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 线程仍在使用共享连接 (可能处于 BEGIN IMMEDIATE 事务中)，等它结束后才能释放锁
+                while not future.done():
+                    try:
+                        await asyncio.shield(future)
+                    except asyncio.CancelledError:
+                        pass
+                raise
+
+    async def get(self, session_key: str) -> Dict[str, Any]:
+        return await self._run(self._get_sync, session_key)
+
+    async def get_many(self, session_keys: List[str]) -> List[Dict[str, Any]]:
+        return await self._run(self._get_many_sync, session_keys)
+
+    async def update(self, session_key: str, data: Dict[str, Any]):
+        await self._run(self._update_sync, session_key, data)
+
+    async def close(self):
+        async with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class RedisReplyError(RuntimeError):
+    """Redis 返回的 -ERR 回复；抛出前已读完同一批命令的全部回复，连接仍可复用。"""
+
+
+class RedisSessionStore(BaseSessionStore):
+    """
+    基于 Redis 协议 (RESP) 的会话存储，适用于多副本部署。
+    不依赖 redis 客户端库，任何兼容 RESP 的服务（Redis、KeyDB、本地替身）均可使用。
+    每个会话保存为一个 Hash，字段值为 JSON；更新通过 MULTI/EXEC 原子地合并字段并刷新过期时间。
+    """
+
+    def __init__(self, url: str, ttl: int, prefix: str = "mymap-2api:session:"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = asyncio.Lock()
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    @staticmethod
+    def _encode(*args: Any) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            value = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        return b"".join(parts)
+
+    async def _read_reply(self) -> Any:
+        line = await self._reader.readline()
+        if not line: raise ConnectionError("Redis 连接已关闭。")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+": return body.decode("utf-8")
+        if kind == b"-": return RedisReplyError(f"Redis 错误: {body.decode('utf-8')}")
+        if kind == b":": return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0: return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            if length < 0: return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"无法解析的 Redis 响应: {line!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password: await self._execute([("AUTH", self.password)])
+        if self.db: await self._execute([("SELECT", self.db)])
+
+    async def _execute(self, commands: List[tuple]) -> List[Any]:
+        self._writer.write(b"".join(self._encode(*command) for command in commands))
+        await self._writer.drain()
+        # 先读完所有回复再报告错误，否则剩余回复会留在连接上被下一个命令读到
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            for item in (reply if isinstance(reply, list) else (reply,)):
+                if isinstance(item, RedisReplyError): raise item
+        return replies
+
+    async def _pipeline(self, commands: List[tuple]) -> List[Any]:
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None: await self._connect()
+                    return await self._execute(commands)
+                except RedisReplyError:
+                    raise
+                except (ConnectionError, asyncio.IncompleteReadError, OSError):
+                    self._drop()
+                    if attempt: raise
+                except BaseException:
+                    # 命令已写出但回复未读完 (调用方被取消等)，连接上的回复序列已错位，不能再复用
+                    self._drop()
+                    raise
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _reset(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        self._reader = self._writer = None
+
+    @staticmethod
+    def _decode_hash(reply: Optional[List[bytes]]) -> Dict[str, Any]:
+        reply = reply or []
+        return {reply[i].decode("utf-8"): json.loads(reply[i + 1]) for i in range(0, len(reply), 2)}
+
+    async def get(self, session_key: str) -> Dict[str, Any]:
+        (reply,) = await self._pipeline([("HGETALL", self.prefix + session_key)])
+        return self._decode_hash(reply)
+
+    async def get_many(self, session_keys: List[str]) -> List[Dict[str, Any]]:
+        if not session_keys: return []
+        replies = await self._pipeline([("HGETALL", self.prefix + session_key) for session_key in session_keys])
+        return [self._decode_hash(reply) for reply in replies]
+
+    async def update(self, session_key: str, data: Dict[str, Any]):
+        if not data: return
+        key = self.prefix + session_key
+        fields = [item for field, value in data.items() for item in (field, json.dumps(value))]
+        await self._pipeline([("MULTI",), ("HSET", key, *fields), ("PEXPIRE", key, int(self.ttl * 1000)), ("EXEC",)])
+
+    async def close(self):
+        async with self.lock:
+            await self._reset()
+
+
+def create_session_store(backend: str, ttl: int, maxsize: int = 1024, sqlite_path: str = "", redis_url: str = "") -> BaseSessionStore:
+    backend = backend.lower()
+    if backend == "memory":
+        return MemorySessionStore(ttl=ttl, maxsize=maxsize)
+    if backend == "sqlite":
+        return SQLiteSessionStore(path=sqlite_path, ttl=ttl)
+    if backend == "redis":
+        return RedisSessionStore(url=redis_url, ttl=ttl)
+    raise ValueError(f"未知的会话存储后端: {backend}")
@@ -0,0 +1,163 @@
+# app/core/upstream.py
+import asyncio
+import logging
+import math
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 收到这些状态码时，请求尚未产生任何内容，可以安全地换一个身份重试
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailableError(Exception):
+    """所有上游身份的熔断器都处于打开状态；retry_after 为最早恢复的身份剩余的熔断秒数。"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamIdentity:
+    """一个上游身份：独立的 X-Distinct-Id 请求头、HTTP/2 连接池和熔断器状态。"""
+
+    def __init__(self, name: str, client: httpx.AsyncClient):
+        self.name = name
+        self.client = client
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.open_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.open_until
+
+    def record_success(self):
+        self.failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, threshold: int, cooldown: float):
+        self.failures += 1
+        if self.failures >= threshold:
+            self.open_until = time.monotonic() + cooldown
+            logger.warning(f"上游身份 {self.name} 连续失败 {self.failures} 次，熔断 {cooldown:.0f} 秒。")
+
+
+class UpstreamManager:
+    """
+    mymap.ai 上游连接管理器。
+    维护多个上游身份，每个请求分配给进行中请求数最少且熔断器未打开的身份；
+    在收到首个字节之前的失败 (连接错误、429、5xx) 会换身份并以带抖动的指数退避重试。
+    """
+
+    def __init__(
+        self, headers_factory: Callable[[], Dict[str, str]], identities: int, timeout: httpx.Timeout, limits: httpx.Limits,
+        retries: int = 2, backoff_base: float = 0.5, backoff_max: float = 8.0, breaker_threshold: int = 3, breaker_cooldown: float = 30.0,
+    ):
+        self.headers_factory = headers_factory
+        self.size = max(1, identities)
+        self.timeout = timeout
+        self.limits = limits
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.identities: List[UpstreamIdentity] = []
+        self.retried = 0
+
+    async def initialize(self, warm_url: Optional[str] = None):
+        self.identities = [
+            UpstreamIdentity(f"#{i}", httpx.AsyncClient(headers=self.headers_factory(), timeout=self.timeout, limits=self.limits, http2=True))
+            for i in range(self.size)
+        ]
+        if warm_url:
+            await asyncio.gather(*(self._warm(identity, warm_url) for identity in self.identities))
+
+    async def _warm(self, identity: UpstreamIdentity, url: str):
+        """预先建立连接 (TCP + TLS + HTTP/2)，失败不影响启动。"""
+        try:
+            await identity.client.head(url, timeout=10)
+        except httpx.HTTPError as e:
+            logger.warning(f"上游身份 {identity.name} 预热失败: {e}")
+
+    async def close(self):
+        for identity in self.identities:
+            await identity.client.aclose()
+        self.identities = []
+
+    def _pick(self) -> UpstreamIdentity:
+        now = time.monotonic()
+        candidates = [identity for identity in self.identities if identity.available(now)]
+        if not candidates:
+            retry_after = min((identity.open_until - now for identity in self.identities), default=1)
+            raise UpstreamUnavailableError("上游服务暂时不可用 (所有身份均已熔断)，请稍后重试。", max(1, math.ceil(retry_after)))
+        return min(candidates, key=lambda identity: identity.inflight)
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        retry_after = response.headers.get("retry-after", "") if response is not None else ""
+        if retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs: Any) -> AsyncIterator[httpx.Response]:
+        """发送流式请求并返回响应；响应头到达前的失败会自动重试，之后不再重试。"""
+        attempt = 0
+        while True:
+            identity = self._pick()
+            identity.inflight += 1
+            identity.requests += 1
+            try:
+                try:
+                    response = await identity.client.send(identity.client.build_request(method, url, **kwargs), stream=True)
+                except httpx.TransportError as e:
+                    identity.record_failure(self.breaker_threshold, self.breaker_cooldown)
+                    if attempt >= self.retries: raise
+                    logger.warning(f"上游请求失败 ({e.__class__.__name__})，第 {attempt + 1} 次重试...")
+                    delay = self._backoff(attempt)
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        identity.record_success()
+                        try:
+                            yield response
+                        finally:
+                            await response.aclose()
+                        return
+                    identity.record_failure(self.breaker_threshold, self.breaker_cooldown)
+                    if attempt >= self.retries:
+                        try:
+                            yield response
+                        finally:
+                            await response.aclose()
+                        return
+                    logger.warning(f"上游返回 {response.status_code}，第 {attempt + 1} 次重试...")
+                    delay = self._backoff(attempt, response)
+                    await response.aclose()
+            finally:
+                identity.inflight -= 1
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(delay)
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """发送普通请求并读取完整响应体，重试策略同 stream()。"""
+        async with self.stream(method, url, **kwargs) as response:
+            await response.aread()
+            return response
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "retried": self.retried,
+            "identities": [
+                {"name": identity.name, "inflight": identity.inflight, "requests": identity.requests,
+                 "failures": identity.failures, "open": not identity.available(now)}
+                for identity in self.identities
+            ],
+        }
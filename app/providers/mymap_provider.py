@@ -4,19 +4,30 @@ import time
 import uuid
 import logging
 import asyncio
-import base64
-import re
-import math
-from typing import Dict, Any, AsyncGenerator, Optional, List
-from xml.etree import ElementTree as ET
-from cachetools import TTLCache
-from threading import Lock
+from typing import Dict, Any, AsyncGenerator, AsyncIterator, Callable, Optional, List, Tuple, Union
 
 from fastapi import HTTPException, Request
 from fastapi.responses import StreamingResponse, JSONResponse
+from starlette.background import BackgroundTask
 
 from app.core.config import settings
-from app.utils.sse_utils import create_sse_data, create_chat_completion_chunk, DONE_CHUNK
+from app.core.session_store import MemorySessionStore, create_session_store
+from app.core.admission import AdmissionController, AdmissionRejected, AdmissionSlot
+from app.core.upstream import UpstreamManager, UpstreamUnavailableError
+from app.core.metrics import (
+    registry, UPSTREAM_TTFB, UPSTREAM_STREAM_DURATION, CLIENT_TTFB, STREAM_CHUNKS, STREAM_BYTES, STREAMS_IN_FLIGHT, STREAM_ERRORS,
+    STREAMS_CANCELLED, CONVERT_DURATION, UPLOAD_STAGE_DURATION, SESSION_CACHE_HITS, SESSION_CACHE_MISSES,
+    PREFIX_INDEX_HITS, PREFIX_INDEX_MISSES, PREFIX_INDEX_EVICTIONS
+)
+from app.utils.sse_utils import ChatCompletionChunkEncoder, coalesce_text, create_chat_completion, estimate_tokens, DONE_CHUNK
+from app.utils.file_stream import sniff_mime_type, base64_decoded_size, aiter_base64_decode, read_head, limit_stream, spool_stream, aiter_file
+from app.utils.signed_url_pool import SignedUrlPool
+from app.utils.conversation_index import ReplyDigest, prefix_hashes, prefix_candidates, prefix_index_key, chat_head_key, PREFIX_KEY
+from app.utils.upload_cache import UploadCache, conditional_headers, data_url_cache_key, remote_url_cache_key, remote_url_validator
+from app.utils.stream_parser import create_utf8_decoder, VisualBlockScanner
+from app.utils.visual_renderer import VisualRenderer
+from app.utils.loop_monitor import EventLoopLagMonitor
+from app.utils.client_address import client_address
 
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -24,29 +35,90 @@ logger = logging.getLogger(__name__)
 
 class MyMapProvider:
     def __init__(self):
-        self.client: Optional[httpx.AsyncClient] = None
-        self.session_cache = TTLCache(maxsize=1024, ttl=settings.SESSION_CACHE_TTL)
-        self.session_lock = Lock()
-        self.base_url = "https://www.mymap.ai"
+        self.upstream = UpstreamManager(
+            self._prepare_headers, identities=settings.UPSTREAM_IDENTITIES,
+            timeout=httpx.Timeout(settings.API_REQUEST_TIMEOUT, connect=settings.UPSTREAM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.UPSTREAM_MAX_CONNECTIONS, max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY
+            ),
+            retries=settings.UPSTREAM_RETRIES, backoff_base=settings.UPSTREAM_BACKOFF_BASE, backoff_max=settings.UPSTREAM_BACKOFF_MAX,
+            breaker_threshold=settings.UPSTREAM_BREAKER_THRESHOLD, breaker_cooldown=settings.UPSTREAM_BREAKER_COOLDOWN
+        )
+        self.download_client: Optional[httpx.AsyncClient] = None
+        self.upload_client: Optional[httpx.AsyncClient] = None
+        self.session_store = create_session_store(
+            settings.SESSION_BACKEND, ttl=settings.SESSION_CACHE_TTL, maxsize=settings.SESSION_CACHE_MAXSIZE,
+            sqlite_path=settings.SESSION_SQLITE_PATH, redis_url=settings.SESSION_REDIS_URL
+        )
+        # 前缀索引: memory 后端下单独计算容量，避免大量无 user 的请求挤掉 user 会话；sqlite / redis 不按容量淘汰，共用同一存储
+        self.prefix_store = self.session_store
+        if isinstance(self.session_store, MemorySessionStore):
+            self.prefix_store = MemorySessionStore(ttl=settings.SESSION_CACHE_TTL, maxsize=settings.PREFIX_INDEX_MAXSIZE, evictions=PREFIX_INDEX_EVICTIONS)
+        self.upload_cache = UploadCache(maxsize=settings.UPLOAD_CACHE_MAXSIZE, ttl=settings.UPLOAD_CACHE_TTL)
+        self.signed_url_pool = SignedUrlPool(
+            self._get_signed_upload_url, settings.SIGNED_URL_POOL_TYPES, max_size=settings.SIGNED_URL_POOL_MAX,
+            ttl=settings.SIGNED_URL_TTL, margin=settings.SIGNED_URL_EXPIRY_MARGIN
+        )
+        self.visual_renderer = VisualRenderer(
+            maxsize=settings.VISUAL_CACHE_MAXSIZE, executor=settings.VISUAL_RENDER_EXECUTOR, workers=settings.VISUAL_RENDER_WORKERS,
+            timeout=settings.VISUAL_RENDER_TIMEOUT, max_xml_bytes=settings.VISUAL_MAX_XML_BYTES
+        )
+        self.loop_monitor = EventLoopLagMonitor()
+        self.admission = AdmissionController(
+            settings.MAX_CONCURRENT_STREAMS, max_queue=settings.STREAM_QUEUE_SIZE, queue_timeout=settings.STREAM_QUEUE_TIMEOUT,
+            max_queue_per_key=settings.STREAM_QUEUE_PER_KEY
+        )
+        self._register_metrics()
+        self.base_url = settings.MYMAP_BASE_URL.rstrip("/")
         self.chat_url = f"{self.base_url}/sapi/aichat"
         self.query_url = f"{self.base_url}/sapi/query"
 
     async def initialize(self):
-        self.client = httpx.AsyncClient(headers=self._prepare_headers(), timeout=settings.API_REQUEST_TIMEOUT, http2=True)
+        await self.upstream.initialize(warm_url=self.base_url if settings.UPSTREAM_WARMUP else None)
+        # 文件下载与 S3 上传使用独立的长连接池，避免每个文件都重新握手
+        file_limits = httpx.Limits(max_connections=settings.UPLOAD_MAX_CONNECTIONS, max_keepalive_connections=settings.UPLOAD_MAX_CONNECTIONS)
+        self.download_client = httpx.AsyncClient(limits=file_limits, timeout=settings.UPLOAD_TIMEOUT)
+        self.upload_client = httpx.AsyncClient(limits=file_limits, timeout=settings.UPLOAD_TIMEOUT)
+        self.signed_url_pool.start()
+        self.loop_monitor.start()
 
     async def close(self):
-        if self.client:
-            await self.client.aclose()
+        await self.loop_monitor.close()
+        await self.signed_url_pool.close()
+        self.visual_renderer.close()
+        await self.upstream.close()
+        for client in (self.download_client, self.upload_client):
+            if client:
+                await client.aclose()
+        await self.session_store.close()
+        if self.prefix_store is not self.session_store:
+            await self.prefix_store.close()
 
-    def _get_session_info(self, session_key: str) -> Dict[str, Any]:
-        with self.session_lock:
-            return self.session_cache.get(session_key, {})
+    def _register_metrics(self):
+        """把各组件 stats() 中的计数注册为抓取时读取的 gauge。"""
+        def stats_collector(stats: Callable[[], Dict[str, Any]]):
+            return lambda: [({"stat": key}, value) for key, value in stats().items()]
+        registry.register_collector("mymap_upload_cache", "上传缓存统计 (entries/hits/misses/shared/revalidated/bytes_saved)", stats_collector(self.upload_cache.stats))
+        registry.register_collector("mymap_signed_url_pool", "预签名 URL 池统计 (pooled/hits/misses/expired/fetched)", stats_collector(self.signed_url_pool.stats))
+        registry.register_collector("mymap_visual_render_cache", "图表渲染缓存统计 (entries/hits/misses/timeouts/oversized)", stats_collector(self.visual_renderer.stats))
+        registry.register_collector("mymap_event_loop_lag_ms", "事件循环延迟 (last/max/avg 毫秒)", lambda: [
+            ({"stat": key}, value) for key, value in self.loop_monitor.stats().items() if key != "samples"
+        ])
+        registry.register_collector("mymap_upstream_identity", "各上游身份的进行中请求数、累计请求数、连续失败数与熔断状态", lambda: [
+            ({"identity": identity["name"], "stat": key}, float(identity[key]))
+            for identity in self.upstream.stats()["identities"] for key in ("inflight", "requests", "failures", "open")
+        ])
+        registry.register_collector("mymap_admission", "准入控制统计 (active/queued/rejected/limit)", stats_collector(self.admission.stats))
+        registry.register_collector("mymap_upstream_retries", "上游请求累计重试次数", lambda: [({}, self.upstream.retried)])
 
-    def _update_session_info(self, session_key: str, data: Dict[str, Any]):
-        with self.session_lock:
-            session_data = self.session_cache.get(session_key, {})
-            session_data.update(data)
-            self.session_cache[session_key] = session_data
+    async def _get_session_info(self, session_key: str) -> Dict[str, Any]:
+        session_info = await self.session_store.get(session_key)
+        (SESSION_CACHE_HITS if session_info else SESSION_CACHE_MISSES).inc()
+        return session_info
+
+    async def _update_session_info(self, session_key: str, data: Dict[str, Any]):
+        await self.session_store.update(session_key, data)
 
     def _prepare_headers(self) -> Dict[str, str]:
         return {
@@ -63,47 +135,101 @@ class MyMapProvider:
         image_url_data = content_part.get("image_url", {})
         url = image_url_data.get("url")
         if not url: raise ValueError("image_url part is missing the 'url' field.")
-        logger.info("检测到文件上传任务，开始处理...")
         if url.startswith("data:"):
-            try:
-                header, encoded = url.split(",", 1)
-                file_data = base64.b64decode(encoded)
-                mime_type = header.split(":")[1].split(";")[0]
-                file_name = f"upload.{mime_type.split('/')[-1]}"
-            except Exception as e:
-                raise ValueError(f"无法解析 Base64 数据 URL: {e}")
-        else:
-            logger.info(f"正在从 URL 下载文件: {url}")
-            async with httpx.AsyncClient() as download_client:
-                response = await download_client.get(url)
+            return await self.upload_cache.get_or_upload(data_url_cache_key(url), lambda: self._upload_data_url(url), size=len(url) * 3 // 4)
+        return await self._upload_remote(url)
+
+    async def _upload_data_url(self, url: str) -> Dict[str, Any]:
+        logger.info("检测到文件上传任务，开始处理...")
+        try:
+            header, encoded = url.split(",", 1)
+            if "\n" in encoded or " " in encoded: encoded = "".join(encoded.split())
+            mime_type = header.split(":")[1].split(";")[0]
+            size = base64_decoded_size(encoded)
+        except Exception as e:
+            raise ValueError(f"无法解析 Base64 数据 URL: {e}")
+        chunks = aiter_base64_decode(encoded, settings.UPLOAD_CHUNK_SIZE)
+        return await self._upload_stream(chunks, size, mime_type, None)
+
+    async def _upload_remote(self, url: str) -> Dict[str, Any]:
+        """
+        远程文件每次都向源站发起条件请求 (If-None-Match / If-Modified-Since)，按 URL + ETag / Last-Modified 查找上传缓存。
+        源站返回 304 时直接复用上次的上传结果，不下载内容；没有校验器的文件每次都重新上传。
+        """
+        known = self.upload_cache.validators.get(url)
+        logger.info("正在从 URL 下载文件: %s", url)
+        download_started = time.perf_counter()
+        # 使用 identity 编码，保证 Content-Length 与实际转发给 S3 的字节数一致
+        headers = {"Accept-Encoding": "identity", **conditional_headers(known)}
+        async with self.download_client.stream("GET", url, headers=headers) as response:
+            UPLOAD_STAGE_DURATION.labels("download_headers").observe(time.perf_counter() - download_started)
+            if response.status_code == 304 and known:
+                cached = self.upload_cache.get(remote_url_cache_key(url, known))
+                if cached is not None: return cached
+                # 上传结果已被淘汰，校验器随之失效，下面重新发起不带条件的请求
+                self.upload_cache.validators.pop(url, None)
+            else:
                 response.raise_for_status()
-                file_data = response.content
-                mime_type = response.headers.get("content-type", "application/octet-stream")
-                file_name = url.split("/")[-1] or f"upload.{mime_type.split('/')[-1]}"
-        logger.info("步骤 1/3: 获取 S3 预签名上传 URL...")
-        signed_url_data = await self._get_signed_upload_url(mime_type)
-        logger.info(f"步骤 2/3: 上传文件到 S3 (ID: {signed_url_data['id']})...")
-        await self._upload_to_s3(signed_url_data["url"], file_data, mime_type)
+                validator = remote_url_validator(response.headers)
+                upload = lambda: self._upload_response(response, url)
+                if validator is None: return await upload()
+                self.upload_cache.validators[url] = validator
+                content_length = response.headers.get("content-length", "")
+                size = int(content_length) if content_length.isdigit() else 0
+                return await self.upload_cache.get_or_upload(remote_url_cache_key(url, validator), upload, size=size)
+        return await self._upload_remote(url)
+
+    async def _upload_response(self, response: httpx.Response, url: str) -> Dict[str, Any]:
+        logger.info("检测到文件上传任务，开始处理...")
+        mime_type = response.headers.get("content-type", "application/octet-stream").split(";")[0].strip()
+        content_length = response.headers.get("content-length", "")
+        size = int(content_length) if content_length.isdigit() else None
+        chunks = response.aiter_bytes(settings.UPLOAD_CHUNK_SIZE)
+        return await self._upload_stream(chunks, size, mime_type, url.split("/")[-1])
+
+    async def _upload_stream(self, chunks: AsyncIterator[bytes], size: Optional[int], declared_type: str, file_name: Optional[str]) -> Dict[str, Any]:
+        max_bytes = settings.UPLOAD_MAX_BYTES
+        if size is not None and size > max_bytes:
+            raise ValueError(f"文件大小 {size} 字节超过上限 {max_bytes} 字节。")
+        head = await read_head(chunks)
+        mime_type = sniff_mime_type(head) or declared_type or "application/octet-stream"
+        file_name = file_name or f"upload.{mime_type.split('/')[-1]}"
+        body = limit_stream(head, chunks, max_bytes)
+        spool = None
+        try:
+            if size is None:
+                # 预签名 PUT 不接受分块传输编码，长度未知时先写入临时文件 (超过 UPLOAD_SPOOL_MEMORY_BYTES 后落盘)，得到长度后再流式上传
+                spool, size = await spool_stream(body, settings.UPLOAD_SPOOL_MEMORY_BYTES)
+                body = aiter_file(spool, settings.UPLOAD_CHUNK_SIZE)
+            logger.info("步骤 1/3: 获取 S3 预签名上传 URL...")
+            with UPLOAD_STAGE_DURATION.labels("signed_url").time():
+                signed_url_data = await self.signed_url_pool.acquire(mime_type)
+            logger.info("步骤 2/3: 上传文件到 S3 (ID: %s, %d 字节)...", signed_url_data["id"], size)
+            with UPLOAD_STAGE_DURATION.labels("s3_put").time():
+                await self._upload_to_s3(signed_url_data["url"], body, mime_type, size)
+        finally:
+            if spool is not None: spool.close()
         logger.info("步骤 3/3: 构建文件消息...")
         final_s3_url = signed_url_data["url"].split("?")[0]
         return {"type": "file", "content": final_s3_url, "card_id": signed_url_data["id"], "file_name": file_name}
 
     async def _get_signed_upload_url(self, content_type: str) -> Dict[str, str]:
         payload = {"operationName": "getSignedUrl", "variables": {"input": {"type": content_type}}, "query": "mutation getSignedUrl($input: SignedUrlPayload!) {\n  getSignedUrl(input: $input) {\n    url\n    id\n    type\n    __typename\n  }\n}\n"}
-        response = await self.client.post(self.query_url, json=payload)
+        response = await self.upstream.request("POST", self.query_url, json=payload)
         response.raise_for_status()
         data = response.json()
         if "errors" in data or "data" not in data or "getSignedUrl" not in data["data"]:
             raise Exception(f"获取签名URL失败: {data.get('errors', '未知GraphQL错误')}")
         return data["data"]["getSignedUrl"]
 
-    async def _upload_to_s3(self, upload_url: str, file_data: bytes, content_type: str):
-        async with httpx.AsyncClient() as upload_client:
-            response = await upload_client.put(upload_url, content=file_data, headers={"Content-Type": content_type})
-            response.raise_for_status()
+    async def _upload_to_s3(self, upload_url: str, content: AsyncIterator[bytes], content_type: str, size: int):
+        headers = {"Content-Type": content_type, "Content-Length": str(size)}
+        response = await self.upload_client.put(upload_url, content=content, headers=headers)
+        response.raise_for_status()
 
     async def _convert_openai_to_mymap(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         mymap_messages = []
+        uploads = []
         for msg in messages:
             if msg.get("role") == "user":
                 content = msg.get("content")
@@ -111,173 +237,344 @@ class MyMapProvider:
                 elif isinstance(content, list):
                     for part in content:
                         if part.get("type") == "text": mymap_messages.append({"type": "text", "content": part.get("text", "")})
-                        elif part.get("type") == "image_url": mymap_messages.append(await self._handle_file_upload(part))
+                        elif part.get("type") == "image_url":
+                            slot: Dict[str, Any] = {}
+                            mymap_messages.append(slot)
+                            uploads.append((slot, part))
             elif msg.get("role") == "system": mymap_messages.insert(0, {"type": "text", "content": msg.get("content", "")})
+        if uploads:
+            # 所有文件并发上传 (受 UPLOAD_CONCURRENCY 限制)，结果按占位写回以保持消息顺序
+            semaphore = asyncio.Semaphore(max(1, settings.UPLOAD_CONCURRENCY))
+            async def upload(part: Dict[str, Any]) -> Dict[str, Any]:
+                async with semaphore:
+                    return await self._handle_file_upload(part)
+            tasks = [asyncio.ensure_future(upload(part)) for _, part in uploads]
+            try:
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks: task.cancel()
+                raise
+            for (slot, _), result in zip(uploads, results):
+                slot.update(result)
         return mymap_messages
 
-    def _parse_mindmap_xml(self, xml_content):
-        xml_content = re.sub(r'\sxmlns="[^"]+"', '', xml_content, count=1)
-        root = ET.fromstring(xml_content)
-        title = root.get('title', '思维导图')
-        content = "".join(root.itertext()).strip()
-        return {'title': title, 'content': content}
-
-    def _markdown_to_tree(self, content):
-        lines = content.split('\n')
-        nodes = []
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-            match = re.match(r'^(#+)\s*(.*)', line)
-            if match:
-                level = len(match.group(1))
-                text = match.group(2).strip()
-                nodes.append({'level': level, 'text': text, 'description': '', 'children': []})
-            elif nodes:
-                nodes[-1]['description'] += f' {line}'
-        if not nodes: return []
-        root_node = nodes.pop(0)
-        tree = {'text': root_node['text'], 'description': root_node['description'].strip(), 'children': [], 'level': root_node['level']}
-        stack = [tree]
-        for node in nodes:
-            current = {'text': node['text'], 'description': node['description'].strip(), 'children': [], 'level': node['level']}
-            while len(stack) > 1 and stack[-1]['level'] >= node['level']: stack.pop()
-            stack[-1]['children'].append(current)
-            stack.append(current)
-        return [tree]
-
-    def _generate_mindmap_html(self, tree_data, title="思维导图"):
-        def get_icon(level): return {1: "🌊", 2: "📚", 3: "🚫"}.get(level, "📌")
-        def gen_children(children, level):
-            if not children: return ""
-            html = '<div class="sub-items">'
-            for child in children:
-                html += f'<div class="sub-item"><div class="sub-item-title">{get_icon(level)} {child["text"]}</div>'
-                if child.get('description'): html += f'<div class="sub-item-description">{child["description"]}</div>'
-                html += '</div>'
-            return html + '</div>'
-        def gen_branches(children, level):
-            if not children: return ""
-            html = ""
-            for child in children:
-                html += f'<div class="branch"><div class="branch-title"><div class="branch-icon">{get_icon(level)}</div>{child["text"]}</div>'
-                if child.get('description'): html += f'<div class="branch-description">{child["description"]}</div>'
-                html += gen_children(child.get('children', []), level + 1) + '</div>'
-            return html
-        center = tree_data[0] if tree_data else {'text': '中心主题', 'description': '', 'children': []}
-        center_html = f'<div class="center-node pulse"><div class="node-title">{center["text"]}</div>'
-        if center.get('description'): center_html += f'<div class="node-desc">{center["description"]}</div>'
-        center_html += '</div>'
-        branches_html = f"<div class='branches'>{gen_branches(center.get('children', []), 1)}</div>"
-        return f'<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>{title}</title><style>body{{font-family:sans-serif;background:linear-gradient(135deg,#667eea 0%,#764ba2 100%);padding:20px;display:flex;justify-content:center;align-items:center;}} .container{{background:white;border-radius:20px;box-shadow:0 20px 60px rgba(0,0,0,0.3);padding:40px;max-width:1200px;}} .title{{text-align:center;color:#2c3e50;font-size:2.5em;margin-bottom:30px;}} .mindmap{{display:flex;justify-content:center;align-items:center;gap:60px;}} .center-node{{background:linear-gradient(135deg,#3498db,#2980b9);color:white;padding:30px;border-radius:15px;font-size:1.8em;text-align:center;box-shadow:0 10px 30px rgba(52,152,219,0.3);z-index:10;}} .branches{{display:flex;flex-direction:column;gap:30px;}} .branch{{background:#f8f9fa;border-radius:15px;padding:25px;box-shadow:0 5px 20px rgba(0,0,0,0.1);border-left:5px solid #3498db;}} .branch-title{{color:#2c3e50;font-size:1.4em;font-weight:bold;margin-bottom:15px;display:flex;align-items:center;gap:10px;}} .branch-icon{{width:30px;height:30px;background:#3498db;border-radius:50%;display:flex;align-items:center;justify-content:center;color:white;font-size:1.2em;flex-shrink:0;}} .sub-items{{display:flex;flex-direction:column;gap:15px;}} .sub-item{{background:white;padding:15px 20px;border-radius:10px;border-left:3px solid #e74c3c;box-shadow:0 2px 10px rgba(0,0,0,0.05);}} .pulse{{animation:pulse 2s infinite;}} @keyframes pulse{{0%{{box-shadow:0 10px 30px rgba(52,152,219,0.3);}}50%{{box-shadow:0 10px 40px rgba(52,152,219,0.5);}}100%{{box-shadow:0 10px 30px rgba(52,152,219,0.3);}}}} @media (max-width:992px){{.mindmap{{flex-direction:column;}} .branches{{width:100%;}}}}</style></head><body><div class="container"><h1 class="title">🌊 {title}</h1><div class="mindmap">{center_html}{branches_html}</div></div></body></html>'
-
-    # **【全新功能】** 流程图专用渲染器
-    def _generate_flowchart_html(self, root: ET.Element):
-        title = root.get('title', '流程图')
-        width = root.get('width', '1000')
-        height = root.get('height', '800')
-        
-        nodes = {elem.get('id'): elem for elem in root.findall('text')}
-        boxes_html = ""
-        for elem_id, elem in nodes.items():
-            style = elem.get('style', '')
-            shape = elem.get('shape', 'rectangle')
-            text_content = (elem.text or "").strip().replace('\n', '<br>')
-            box_html = f"<div class='box {style} shape_{shape}' style='left:{elem.get('x')}px; top:{elem.get('y')}px; width:{elem.get('width')}px; height:{elem.get('height')}px;'><div>{text_content}</div></div>"
-            boxes_html += box_html
-        
-        lines_html = ""
-        for line in root.findall('line'):
-            start_node = nodes.get(line.get('start-node'))
-            end_node = nodes.get(line.get('end-node'))
-            if start_node is not None and end_node is not None:
-                x1 = float(start_node.get('x')) + float(start_node.get('width')) / 2
-                y1 = float(start_node.get('y')) + float(start_node.get('height'))
-                x2 = float(end_node.get('x')) + float(end_node.get('width')) / 2
-                y2 = float(end_node.get('y'))
-                
-                length = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-                angle = math.degrees(math.atan2(y2 - y1, x2 - x1)) - 90
-                
-                lines_html += f"<div class='line' style='height:{length}px; left:{x1}px; top:{y1}px; transform:rotate({angle}deg);'></div>"
-
-        return f'<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>{title}</title><style>body{{background:#f0f2f5;}} .flowchart{{position:relative;width:{width}px;height:{height}px;margin:auto;background-image:linear-gradient(45deg,#e9ecef 25%,transparent 25%),linear-gradient(-45deg,#e9ecef 25%,transparent 25%),linear-gradient(45deg,transparent 75%,#e9ecef 75%),linear-gradient(-45deg,transparent 75%,#e9ecef 75%);background-size:20px 20px;border:1px solid #dee2e6;}} .box{{position:absolute;padding:10px;border:2px solid #343a40;background-color:#fff;text-align:center;box-shadow:0 2px 4px rgba(0,0,0,0.05);display:flex;align-items:center;justify-content:center;}} .shape_circle{{border-radius:50%;}} .shape_rectangle{{border-radius:8px;}} .border_blue{{border-color:#4a90e2;}} .border_green{{border-color:#7ed321;}} .border_yellow{{border-color:#f5a623;}} .border_purple{{border-color:#9013fe;}} .border_orange{{border-color:#f88010;}} .line{{position:absolute;background-color:#808080;width:2px;transform-origin:top center;}}</style></head><body><div class="flowchart">{boxes_html}{lines_html}</div></body></html>'
-
-    # **【智能分发】** 根据类型调用不同的渲染器
-    def _convert_visual_to_html(self, xml_content):
+    @staticmethod
+    def _index_owner(request: Optional[Request]) -> str:
+        """前缀索引的归属方: API Key + 客户端地址，只续用同一客户端自己创建的上游会话。"""
+        if request is None: return "-"
+        authorization = request.headers.get("authorization", "")
+        return f"{authorization.split(' ')[-1]}\x1f{client_address(request, settings.TRUSTED_PROXY_IPS)}"
+
+    async def _lookup_prefix(self, messages: List[Dict[str, Any]], hashes: List[str], owner: str) -> Tuple[Dict[str, Any], int]:
+        """
+        未提供 user 时，按最长匹配前缀在前缀索引中查找该客户端可续用的上游会话，返回会话信息与已转发的消息数。
+        所有候选前缀在一次批量查询中取回，命中时再查一次该会话的推进位置，最多两次后端往返。
+        """
+        counts = list(prefix_candidates(messages))
+        entries = await self.prefix_store.get_many([prefix_index_key(hashes[count - 1], owner) for count in counts])
+        for count, session_info in zip(counts, entries):
+            chat_id = session_info.get("chat_id")
+            if not chat_id: continue
+            # 上游会话已在该前缀之后继续推进 (客户端编辑或回退了历史)，不能续用
+            head = await self.prefix_store.get(chat_head_key(chat_id))
+            if head.get("forwarded_digest") != hashes[count - 1]: break
+            PREFIX_INDEX_HITS.inc()
+            return session_info, count
+        PREFIX_INDEX_MISSES.inc()
+        return {}, 0
+
+    @staticmethod
+    def _admission_key(request: Optional[Request], request_data: Dict[str, Any]) -> str:
+        """
+        排队公平性的粒度: 优先按会话 (user)，其次按客户端地址 (经可信代理转发时取真实地址)。
+        所有客户端共用同一个 API_MASTER_KEY，按 API Key 区分只在拿不到客户端地址时兜底。
+        """
+        if request_data.get("user"): return f"user:{request_data['user']}"
+        address = client_address(request, settings.TRUSTED_PROXY_IPS)
+        if address != "-": return f"ip:{address}"
+        authorization = request.headers.get("authorization") if request is not None else None
+        return f"key:{authorization.split(' ')[-1]}" if authorization else "-"
+
+    async def chat_completion(self, request: Request, request_data: Dict[str, Any]) -> Union[StreamingResponse, JSONResponse]:
+        started_at = time.perf_counter()
         try:
-            xml_content = re.sub(r'\sxmlns="[^"]+"', '', xml_content, count=1)
-            root = ET.fromstring(xml_content)
-            visual_type = root.get("type", "")
-
-            if 'mindmap' in visual_type:
-                data = self._parse_mindmap_xml(xml_content)
-                tree_data = self._markdown_to_tree(data['content'])
-                return self._generate_mindmap_html(tree_data, data['title'])
-            elif 'flowchart' in visual_type:
-                return self._generate_flowchart_html(root)
-            else:
-                # 提供一个后备的简单渲染
-                return f"<h1>未知图表类型</h1><pre>{ET.tostring(root, encoding='unicode')}</pre>"
-        except Exception as e:
-            logger.error(f"生成HTML时出错: {e}", exc_info=True)
-            return f"<h1>HTML Generation Error</h1><p>{e}</p>"
+            slot = await self.admission.acquire(self._admission_key(request, request_data))
+        except AdmissionRejected as e:
+            logger.warning("准入控制拒绝请求: %s (active=%d, queued=%d)", e, self.admission.active, self.admission.queued)
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        try:
+            return await self._start_completion(request, request_data, slot, started_at)
+        except BaseException:
+            slot.release()
+            raise
 
-    async def chat_completion(self, request: Request, request_data: Dict[str, Any]) -> StreamingResponse:
-        session_key = request_data.get("user", str(uuid.uuid4()))
-        session_info = self._get_session_info(session_key)
+    async def _start_completion(self, request: Optional[Request], request_data: Dict[str, Any], slot: AdmissionSlot, started_at: float) -> Union[StreamingResponse, JSONResponse]:
+        openai_messages = request_data.get("messages", [])
+        hashes = prefix_hashes(openai_messages)
+        session_key = request_data.get("user")
+        owner = self._index_owner(request)
+        if session_key:
+            session_info = await self._get_session_info(session_key)
+            forwarded_count = session_info.get("forwarded_count", 0)
+            if not (0 < forwarded_count < len(openai_messages) and hashes[forwarded_count - 1] == session_info.get("forwarded_digest")):
+                forwarded_count = 0
+        else:
+            session_info, forwarded_count = await self._lookup_prefix(openai_messages, hashes, owner)
         chat_id = session_info.get("chat_id")
         board_id = session_info.get("board_id", str(uuid.uuid4().hex[:13]))
-        openai_messages = request_data.get("messages", [])
-        mymap_messages = await self._convert_openai_to_mymap(openai_messages)
+        new_messages = openai_messages
+        if chat_id:
+            # 上游会话已持有之前转发过的消息，历史未被修改时只发送新增部分
+            if forwarded_count:
+                new_messages = openai_messages[forwarded_count:]
+            else:
+                logger.info("会话 '%s' 的历史消息已被修改或截断，重新发送完整历史并开启新的上游会话。", session_key or "-")
+                chat_id = None
+        with CONVERT_DURATION.time():
+            mymap_messages = await self._convert_openai_to_mymap(new_messages)
+            if chat_id and not mymap_messages:
+                chat_id = None
+                mymap_messages = await self._convert_openai_to_mymap(openai_messages)
         payload = {"messages": mymap_messages, "board_id": board_id, "playground": True}
         if chat_id: payload["id"] = chat_id
         model = request_data.get("model", settings.DEFAULT_MODEL)
-        return StreamingResponse(self._stream_generator(session_key, board_id, payload, model), media_type="text/event-stream")
+        fingerprint = {"forwarded_count": len(openai_messages), "forwarded_digest": hashes[-1] if hashes else ""}
+        if not request_data.get("stream", False):
+            try:
+                return await self._complete_until_disconnect(request, session_key, board_id, payload, model, fingerprint, owner, openai_messages)
+            finally:
+                slot.release()
+        stream = self._instrument_stream(self._stream_generator(session_key, board_id, payload, model, fingerprint, owner), started_at, request, slot)
+        # 流从未开始 (例如客户端在响应头发出前断开) 时由后台任务兜底释放名额
+        return StreamingResponse(stream, media_type="text/event-stream", background=BackgroundTask(slot.release))
+
+    @staticmethod
+    async def _wait_disconnect(request: Request):
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect": return
+
+    async def _until_disconnect(self, stream: AsyncGenerator[bytes, None], request: Request) -> AsyncGenerator[bytes, None]:
+        """每次读取都与客户端断开竞争；断开时只取消正在进行的上游读取，然后正常结束，不取消响应所在的任务。"""
+        watcher = asyncio.ensure_future(self._wait_disconnect(request))
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                pending = asyncio.ensure_future(stream.__anext__())
+                await asyncio.wait((pending, watcher), return_when=asyncio.FIRST_COMPLETED)
+                if not pending.done():
+                    pending.cancel()
+                    await asyncio.wait((pending,))
+                    STREAMS_CANCELLED.inc()
+                    logger.info("客户端已断开，取消流式响应。")
+                    return
+                try:
+                    chunk = pending.result()
+                except StopAsyncIteration:
+                    return
+                pending = None
+                yield chunk
+        finally:
+            watcher.cancel()
+            if pending is not None and not pending.done():
+                pending.cancel()
+                # 等待读取任务结束，否则随后的 stream.aclose() 会遇到仍在运行的生成器
+                await asyncio.wait((pending,))
 
-    async def _stream_generator(self, session_key: str, board_id: str, payload: Dict, model: str) -> AsyncGenerator[bytes, None]:
-        request_id = f"chatcmpl-{uuid.uuid4()}"
-        full_response_content = ""
+    async def _instrument_stream(self, stream: AsyncGenerator[bytes, None], started_at: float, request: Optional[Request], slot: AdmissionSlot) -> AsyncGenerator[bytes, None]:
+        """
+        统计客户端可见的首字节时间、每个流的事件数与字节数，以及进行中的流数量；结束时释放准入名额。
+        客户端断开时立即取消流，上游响应随 `async with` 退出而关闭。ASGI spec_version < 2.4 (如 uvicorn) 时
+        Starlette 自身会监听 http.disconnect 并取消流；>= 2.4 时 Starlette 只在写失败时才发现断开，由 _until_disconnect 监听。
+        """
+        chunk_count = byte_count = 0
+        source = stream
+        spec_version = request.scope.get("asgi", {}).get("spec_version", "2.0") if request is not None else "2.0"
+        if tuple(map(int, spec_version.split("."))) >= (2, 4):
+            source = self._until_disconnect(stream, request)
+        STREAMS_IN_FLIGHT.inc()
         try:
-            async with self.client.stream("POST", self.chat_url, json=payload) as response:
-                if response.status_code == 200 and "x-chat-id" in response.headers:
-                    new_chat_id = response.headers["x-chat-id"]
-                    self._update_session_info(session_key, {"chat_id": new_chat_id, "board_id": board_id})
-                    logger.info(f"会话 '{session_key}' 已关联到 chat_id: {new_chat_id}")
+            async for chunk in source:
+                if not chunk_count: CLIENT_TTFB.observe(time.perf_counter() - started_at)
+                chunk_count += 1
+                byte_count += len(chunk)
+                yield chunk
+        except asyncio.CancelledError:
+            STREAMS_CANCELLED.inc()
+            logger.info("客户端已断开，取消流式响应 (已输出 %d 个事件)。", chunk_count)
+            raise
+        finally:
+            slot.release()
+            STREAMS_IN_FLIGHT.dec()
+            STREAM_CHUNKS.observe(chunk_count)
+            STREAM_BYTES.observe(byte_count)
+            if source is not stream: await source.aclose()
+            await stream.aclose()
+
+    async def _iter_upstream_text(self, response: httpx.Response) -> AsyncGenerator[str, None]:
+        decoder = create_utf8_decoder()
+        async for chunk_bytes in response.aiter_bytes():
+            chunk_str = decoder.decode(chunk_bytes)
+            if chunk_str: yield chunk_str
+        tail = decoder.decode(b"", final=True)
+        if tail: yield tail
+
+    async def _bind_chat_id(self, response: httpx.Response, session_key: Optional[str], board_id: str, fingerprint: Dict[str, Any], log_key: str) -> Optional[str]:
+        """收到上游响应头时记录 x-chat-id；提供了 user 时立即写入会话。"""
+        if response.status_code != 200 or "x-chat-id" not in response.headers: return None
+        new_chat_id = response.headers["x-chat-id"]
+        if session_key: await self._update_session_info(session_key, {"chat_id": new_chat_id, "board_id": board_id, **fingerprint})
+        logger.info("会话 '%s' 已关联到 chat_id: %s", log_key, new_chat_id)
+        return new_chat_id
+
+    async def _record_turn(self, new_chat_id: Optional[str], session_key: Optional[str], board_id: str, reply: Optional[ReplyDigest], owner: str):
+        if new_chat_id and not session_key and reply is not None:
+            # 本轮完成后以 "请求消息 + 本轮回复" 登记前缀索引，客户端带着本轮回复继续对话时即可续用该上游会话
+            turn_digest = reply.hexdigest()
+            await self.prefix_store.update(prefix_index_key(turn_digest, owner), {"chat_id": new_chat_id, "board_id": board_id})
+            await self.prefix_store.update(chat_head_key(new_chat_id), {"forwarded_digest": turn_digest})
+
+    async def _stream_generator(self, session_key: Optional[str], board_id: str, payload: Dict, model: str, fingerprint: Dict[str, Any], owner: str) -> AsyncGenerator[bytes, None]:
+        encoder = ChatCompletionChunkEncoder(f"chatcmpl-{uuid.uuid4()}", model)
+        scanner = VisualBlockScanner()
+        visual_count = 0
+        new_chat_id = None
+        reply = ReplyDigest(fingerprint["forwarded_digest"]) if not session_key and fingerprint["forwarded_digest"] else None
+        # 未提供 user 时以消息前缀指纹作为会话标识
+        log_key = session_key or PREFIX_KEY + fingerprint["forwarded_digest"][:12]
+        upstream_started = time.perf_counter()
+        first_byte = True
+        try:
+            async with self.upstream.stream("POST", self.chat_url, json=payload) as response:
+                new_chat_id = await self._bind_chat_id(response, session_key, board_id, fingerprint, log_key)
                 response.raise_for_status()
-                async for chunk_bytes in response.aiter_bytes():
-                    chunk_str = chunk_bytes.decode('utf-8')
-                    full_response_content += chunk_str
-                    yield create_sse_data(create_chat_completion_chunk(request_id, model, chunk_str))
+                chunks = coalesce_text(self._iter_upstream_text(response), settings.SSE_COALESCE_DELAY_MS / 1000, settings.SSE_COALESCE_MAX_CHARS)
+                try:
+                    async for chunk_str in chunks:
+                        if first_byte:
+                            UPSTREAM_TTFB.observe(time.perf_counter() - upstream_started)
+                            first_byte = False
+                        if reply is not None: reply.feed(chunk_str)
+                        yield encoder.encode(chunk_str)
+                        for visual_block in scanner.feed(chunk_str):
+                            visual_count += 1
+                            visual_markdown = await self._render_visual_markdown(visual_block, visual_count)
+                            if reply is not None: reply.feed(visual_markdown)
+                            yield encoder.encode(visual_markdown)
+                finally:
+                    await chunks.aclose()
+                await self._record_turn(new_chat_id, session_key, board_id, reply, owner)
+            UPSTREAM_STREAM_DURATION.observe(time.perf_counter() - upstream_started)
         except httpx.HTTPStatusError as e:
+            STREAM_ERRORS.inc()
             error_message = f"\n\n---\n**错误提示：** 请求上游服务失败。\n- **状态码:** {e.response.status_code}\n- **原因:** {e.response.reason_phrase}"
             logger.error(f"流式请求失败: {e}")
-            yield create_sse_data(create_chat_completion_chunk(request_id, model, error_message))
-            yield create_sse_data(create_chat_completion_chunk(request_id, model, "", "stop")); yield DONE_CHUNK; return
+            yield encoder.encode(error_message)
+            yield encoder.finish(); yield DONE_CHUNK; return
         except Exception as e:
+            STREAM_ERRORS.inc()
             error_message = f"\n\n---\n**未知错误：** {str(e)}"
             logger.error(f"流式生成器发生未知错误: {e}", exc_info=True)
-            yield create_sse_data(create_chat_completion_chunk(request_id, model, error_message))
-            yield create_sse_data(create_chat_completion_chunk(request_id, model, "", "stop")); yield DONE_CHUNK; return
-        
+            yield encoder.encode(error_message)
+            yield encoder.finish(); yield DONE_CHUNK; return
+
+        yield encoder.finish()
+        yield DONE_CHUNK
+        logger.info("会话 '%s' 流式传输结束，共转换 %d 个 visual 块。", log_key, visual_count)
+
+    async def _complete_until_disconnect(self, request: Optional[Request], *args) -> JSONResponse:
+        """非流式请求在等待完整回复期间同样监听客户端断开，断开时取消上游请求。"""
+        if request is None: return await self._complete(*args)
+        completion = asyncio.ensure_future(self._complete(*args))
+        watcher = asyncio.ensure_future(self._wait_disconnect(request))
+        try:
+            await asyncio.wait((completion, watcher), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            watcher.cancel()
+            if not completion.done():
+                completion.cancel()
+                # 等待上游连接随取消释放后再返回
+                await asyncio.wait((completion,))
+        if not completion.done() or completion.cancelled():
+            STREAMS_CANCELLED.inc()
+            logger.info("客户端已断开，取消非流式请求。")
+            # 客户端已不在，响应内容不会被发送
+            return JSONResponse(status_code=499, content={"detail": "客户端已断开。"})
+        return completion.result()
+
+    async def _complete(self, session_key: Optional[str], board_id: str, payload: Dict, model: str, fingerprint: Dict[str, Any], owner: str, openai_messages: List[Dict[str, Any]]) -> JSONResponse:
+        """
+        非流式补全: 上游文本块追加到列表，visual 块在读取过程中即提交渲染，最后一次性拼接为 chat.completion。
+        会话 / chat_id / 前缀索引的记录与流式路径相同。
+        """
+        scanner = VisualBlockScanner()
+        parts: List[Union[str, asyncio.Future]] = []
+        renders: List[asyncio.Future] = []
+        log_key = session_key or PREFIX_KEY + fingerprint["forwarded_digest"][:12]
+        upstream_started = time.perf_counter()
         try:
-            pattern = re.compile(r'<visual.*?</visual>', re.DOTALL)
-            captured_visual_blocks = pattern.findall(full_response_content)
-            if captured_visual_blocks:
-                logger.info(f"原始流传输完毕。检测到 {len(captured_visual_blocks)} 个 visual 块，开始转换并追加。")
-                for i, visual_block in enumerate(captured_visual_blocks):
-                    html_content = self._convert_visual_to_html(visual_block)
-                    html_source_markdown = f"\n\n---\n\n**图表 {i+1} HTML 预览源代码:**\n```html\n{html_content}\n```\n"
-                    yield create_sse_data(create_chat_completion_chunk(request_id, model, html_source_markdown))
-                    logger.info(f"已追加图表 {i+1} 的HTML源代码。")
+            async with self.upstream.stream("POST", self.chat_url, json=payload) as response:
+                new_chat_id = await self._bind_chat_id(response, session_key, board_id, fingerprint, log_key)
+                response.raise_for_status()
+                async for chunk_str in self._iter_upstream_text(response):
+                    if not parts: UPSTREAM_TTFB.observe(time.perf_counter() - upstream_started)
+                    parts.append(chunk_str)
+                    for visual_block in scanner.feed(chunk_str):
+                        # 渲染与后续上游读取并行，结果按原位置插入
+                        renders.append(asyncio.ensure_future(self._render_visual_markdown(visual_block, len(renders) + 1)))
+                        parts.append(renders[-1])
+            UPSTREAM_STREAM_DURATION.observe(time.perf_counter() - upstream_started)
+            if renders: await asyncio.wait(renders)
+        except httpx.HTTPStatusError as e:
+            STREAM_ERRORS.inc()
+            logger.error("非流式请求失败: %s", e)
+            raise HTTPException(status_code=502, detail=f"请求上游服务失败: {e.response.status_code} {e.response.reason_phrase}")
+        except UpstreamUnavailableError as e:
+            STREAM_ERRORS.inc()
+            logger.error("非流式请求失败: %s", e)
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        except httpx.RequestError as e:
+            # 重试耗尽后的连接错误，以及读取响应体时的网络 / 协议 / 解码错误
+            STREAM_ERRORS.inc()
+            logger.error("非流式请求失败: %r", e)
+            raise HTTPException(status_code=502, detail=f"请求上游服务失败: {type(e).__name__}: {e}")
+        finally:
+            for render in renders:
+                if not render.done(): render.cancel()
+        content = "".join(part if isinstance(part, str) else part.result() for part in parts)
+        if not session_key and fingerprint["forwarded_digest"]:
+            # 索引按客户端实际收到的回复 (含图表) 登记
+            reply = ReplyDigest(fingerprint["forwarded_digest"])
+            reply.feed(content)
+            await self._record_turn(new_chat_id, session_key, board_id, reply, owner)
+        # completion 只按上游生成的文本估算，不含追加的图表 HTML
+        prompt_tokens = self._estimate_prompt_tokens(openai_messages)
+        completion_tokens = estimate_tokens("".join(part for part in parts if isinstance(part, str)))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        logger.info("会话 '%s' 非流式请求结束，共转换 %d 个 visual 块。", log_key, len(renders))
+        return JSONResponse(content=create_chat_completion(f"chatcmpl-{uuid.uuid4()}", model, content, usage))
+
+    @staticmethod
+    def _estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+        total = 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") for part in content if part.get("type") == "text")
+            total += estimate_tokens(content if isinstance(content, str) else "")
+        return total
+
+    async def _render_visual_markdown(self, visual_block: str, index: int) -> str:
+        try:
+            html_content = await self.visual_renderer.render_async(visual_block)
+            if html_content is None:
+                logger.warning("图表 %d 过大或渲染超时，降级为输出原始 XML。", index)
+                return f"\n\n---\n\n**图表 {index} 过大或渲染超时，原始 XML:**\n```xml\n{visual_block}\n```\n"
+            logger.info("已追加图表 %d 的HTML源代码。", index)
+            return f"\n\n---\n\n**图表 {index} HTML 预览源代码:**\n```html\n{html_content}\n```\n"
         except Exception as e:
             logger.error(f"追加HTML块时出错: {e}", exc_info=True)
-            error_markdown = f"\n\n--- \n**HTML转换失败:** `{str(e)}`"
-            yield create_sse_data(create_chat_completion_chunk(request_id, model, error_markdown))
-
-        yield create_sse_data(create_chat_completion_chunk(request_id, model, "", "stop"))
-        yield DONE_CHUNK
-        logger.info(f"会话 '{session_key}' 流式传输结束（包含追加内容）。")
+            return f"\n\n--- \n**HTML转换失败:** `{str(e)}`"
 
     async def get_models(self) -> JSONResponse:
         return JSONResponse(content={"object": "list", "data": [{"id": name, "object": "model", "created": int(time.time()), "owned_by": "lzA6"} for name in settings.KNOWN_MODELS]})
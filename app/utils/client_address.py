@@ -0,0 +1,33 @@
+# app/utils/client_address.py
+import ipaddress
+from functools import lru_cache
+from typing import List, Optional, Tuple, Union
+
+from fastapi import Request
+
+
+@lru_cache(maxsize=16)
+def _parse_networks(trusted: Tuple[str, ...]) -> Tuple[Union[ipaddress.IPv4Network, ipaddress.IPv6Network], ...]:
+    return tuple(ipaddress.ip_network(item, strict=False) for item in trusted if item != "*")
+
+
+def _is_trusted(host: str, trusted: Tuple[str, ...]) -> bool:
+    if "*" in trusted: return True
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in _parse_networks(trusted))
+
+
+def client_address(request: Optional[Request], trusted_proxies: List[str]) -> str:
+    """
+    客户端真实地址。直连地址属于可信代理 (如 nginx 容器) 时，取代理写入的 X-Real-IP，
+    没有时取 X-Forwarded-For 最右侧一项 (由可信代理追加，客户端无法伪造)。
+    """
+    if request is None or request.client is None: return "-"
+    host = request.client.host
+    if _is_trusted(host, tuple(trusted_proxies)):
+        forwarded = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for", "").split(",")[-1].strip()
+        if forwarded: return forwarded
+    return host
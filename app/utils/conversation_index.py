@@ -0,0 +1,88 @@
+# app/utils/conversation_index.py
+import hashlib
+import json
+from typing import Dict, Any, Iterator, List
+
+from app.utils.upload_cache import data_url_cache_key
+
+PREFIX_KEY = "prefix:"
+CHAT_HEAD_KEY = "chat-head:"
+# 查找最长匹配前缀时最多探测的位置数，正常的多轮对话第一次探测即命中
+MAX_PREFIX_PROBES = 8
+
+
+def normalize_message(message: Dict[str, Any]) -> str:
+    """把一条 OpenAI 消息归一化为 角色 + 文本 + 图片哈希，图片只参与哈希而不展开其内容。"""
+    content = message.get("content")
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if part.get("type") == "text":
+                parts.append(part.get("text", "").strip())
+            elif part.get("type") == "image_url":
+                url = part.get("image_url", {}).get("url", "")
+                parts.append(data_url_cache_key(url) if url.startswith("data:") else f"url:{url}")
+        content = "\x1f".join(parts)
+    elif not isinstance(content, str):
+        content = "" if content is None else json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return f"{message.get('role', '')}\x1e{content.strip()}"
+
+
+def prefix_hashes(messages: List[Dict[str, Any]]) -> List[str]:
+    """滚动哈希：第 i 项是前 i + 1 条消息的指纹，一次遍历即可得到所有前缀的指纹。"""
+    hashes = []
+    digest = ""
+    for message in messages:
+        digest = hashlib.sha256(f"{digest}\x1d{normalize_message(message)}".encode("utf-8")).hexdigest()
+        hashes.append(digest)
+    return hashes
+
+
+class ReplyDigest:
+    """
+    增量计算 "请求消息 + 本轮助手回复" 的指纹，结果与 prefix_hashes 对客户端回传的同一条 assistant 消息计算的一致。
+    回复按块输入，只保留尾部空白 (对应 normalize_message 的 strip)，不需要缓存整段回复。
+    """
+
+    def __init__(self, prefix_digest: str):
+        self._hash = hashlib.sha256(f"{prefix_digest}\x1dassistant\x1e".encode("utf-8"))
+        self._started = False
+        self._trailing = ""
+
+    def feed(self, text: str):
+        if not self._started:
+            text = text.lstrip()
+            if not text: return
+            self._started = True
+        stripped = text.rstrip()
+        if stripped:
+            self._hash.update((self._trailing + stripped).encode("utf-8"))
+            self._trailing = text[len(stripped):]
+        else:
+            self._trailing += text
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def prefix_candidates(messages: List[Dict[str, Any]]) -> Iterator[int]:
+    """
+    按从长到短的顺序给出可能已转发过的前缀长度。
+    索引在一轮完成后以 "请求消息 + 生成的回复" 为键写入，且至少要留下一条新消息，因此只探测以助手消息结尾的真前缀。
+    """
+    probes = 0
+    for count in range(len(messages) - 1, 0, -1):
+        if messages[count - 1].get("role") != "assistant": continue
+        yield count
+        probes += 1
+        if probes >= MAX_PREFIX_PROBES: return
+
+
+def prefix_index_key(digest: str, owner: str) -> str:
+    """索引键包含归属方 (API Key + 客户端地址)，不同客户端即使对话内容相同也不会续用彼此的上游会话。"""
+    return PREFIX_KEY + hashlib.sha256(f"{owner}\x1d{digest}".encode("utf-8")).hexdigest()
+
+
+def chat_head_key(chat_id: str) -> str:
+    """记录上游会话当前已转发到哪个前缀，旧前缀的索引项在会话继续推进后即失效。"""
+    return CHAT_HEAD_KEY + chat_id
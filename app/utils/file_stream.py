@@ -0,0 +1,93 @@
+# app/utils/file_stream.py
+import binascii
+import tempfile
+from typing import AsyncIterator, IO, Optional, Tuple
+
+# 常见文件格式的魔数，用于根据文件开头的字节识别 MIME 类型
+_MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+    (b"BM", "image/bmp"),
+)
+SNIFF_BYTES = 16
+
+
+def sniff_mime_type(head: bytes) -> Optional[str]:
+    """根据文件开头的字节识别 MIME 类型，无法识别时返回 None。"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime_type in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return mime_type
+    return None
+
+
+def base64_decoded_size(encoded: str) -> int:
+    """不解码即可计算 Base64 数据解码后的字节数。"""
+    if len(encoded) % 4:
+        raise ValueError("Base64 数据长度不是 4 的倍数。")
+    return len(encoded) // 4 * 3 - (len(encoded) - len(encoded.rstrip("=")))
+
+
+async def aiter_base64_decode(encoded: str, chunk_size: int) -> AsyncIterator[bytes]:
+    """按块增量解码 Base64 字符串，每次只持有约 chunk_size 字节的解码结果。"""
+    step = max(4, chunk_size // 3 * 4)
+    for start in range(0, len(encoded), step):
+        try:
+            yield binascii.a2b_base64(encoded[start:start + step])
+        except binascii.Error as e:
+            raise ValueError(f"无法解码 Base64 数据: {e}")
+
+
+async def read_head(chunks: AsyncIterator[bytes], size: int = SNIFF_BYTES) -> bytes:
+    """从字节流中读取至少 size 个字节 (流更短时读完为止)，用于 MIME 类型识别。"""
+    head = b""
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= size:
+            break
+    return head
+
+
+async def limit_stream(head: bytes, chunks: AsyncIterator[bytes], max_bytes: int) -> AsyncIterator[bytes]:
+    """先输出已读取的 head，再透传剩余字节流；累计超过 max_bytes 时中止。"""
+    total = len(head)
+    if total > max_bytes:
+        raise ValueError(f"文件大小超过上限 {max_bytes} 字节。")
+    if head:
+        yield head
+    async for chunk in chunks:
+        total += len(chunk)
+        if total > max_bytes:
+            raise ValueError(f"文件大小超过上限 {max_bytes} 字节。")
+        yield chunk
+
+
+async def spool_stream(chunks: AsyncIterator[bytes], max_memory: int) -> Tuple[IO[bytes], int]:
+    """
+    把长度未知的字节流写入临时文件以得到总长度，不超过 max_memory 字节时留在内存，超过后落盘。
+    返回已回到开头的文件与总字节数，调用方负责关闭文件。
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        async for chunk in chunks:
+            # 写入的是 UPLOAD_CHUNK_SIZE 大小的块，落盘后也只是写页缓存，直接在事件循环中进行
+            spool.write(chunk)
+        size = spool.tell()
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, size
+
+
+async def aiter_file(file: IO[bytes], chunk_size: int) -> AsyncIterator[bytes]:
+    """按块读取文件，用于把 spool_stream 的结果流式上传。"""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
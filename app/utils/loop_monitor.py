@@ -0,0 +1,54 @@
+# app/utils/loop_monitor.py
+import asyncio
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopLagMonitor:
+    """
+    事件循环延迟监控：每隔 interval 秒睡眠一次，实际唤醒时间比预期晚多少即为该时刻的循环延迟。
+    延迟超过 warn_threshold 秒时记录警告，用于发现阻塞事件循环的同步代码。
+    """
+
+    def __init__(self, interval: float = 0.5, warn_threshold: float = 0.1):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+        self.samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.last = lag
+            self.max = max(self.max, lag)
+            self.total += lag
+            self.samples += 1
+            if lag > self.warn_threshold:
+                logger.warning(f"事件循环延迟 {lag * 1000:.1f} ms，可能有同步代码阻塞了事件循环。")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "last_ms": round(self.last * 1000, 3), "max_ms": round(self.max * 1000, 3),
+            "avg_ms": round(self.total / self.samples * 1000, 3) if self.samples else 0.0, "samples": self.samples,
+        }
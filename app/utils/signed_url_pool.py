@@ -0,0 +1,108 @@
+# app/utils/signed_url_pool.py
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Deque, Tuple, List, Awaitable, Callable, Optional
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger(__name__)
+
+
+class SignedUrlPool:
+    """
+    预取的 S3 预签名上传 URL 池，按 MIME 类型分别维护。
+    后台任务把每种类型的池补充到目标大小：取用时池为空 (未命中) 则目标加一，
+    池中 URL 未被使用而过期则目标减一，目标在 [0, max_size] 之间随实际需求浮动。
+    目标从 0 开始，从未被请求过或已不再被请求的类型不预取，不产生多余的上游调用。
+    """
+
+    REFILL_INTERVAL = 30
+
+    def __init__(self, fetch: Callable[[str], Awaitable[Dict[str, str]]], mime_types: List[str], max_size: int, ttl: int, margin: int):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.ttl = ttl
+        self.margin = margin
+        self.pools: Dict[str, Deque[Tuple[float, Dict[str, str]]]] = {mime_type: deque() for mime_type in mime_types}
+        self.targets: Dict[str, int] = {mime_type: 0 for mime_type in mime_types}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.fetched = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.max_size > 0 and self.pools and self._task is None:
+            self._task = asyncio.create_task(self._refill_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _expires_at(self, url: str) -> float:
+        """从 X-Amz-Date / X-Amz-Expires 推算 URL 的过期时间，无法解析时使用配置的 TTL。"""
+        query = parse_qs(urlparse(url).query)
+        try:
+            signed_at = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return signed_at.timestamp() + int(query["X-Amz-Expires"][0])
+        except (KeyError, ValueError):
+            return time.time() + self.ttl
+
+    async def acquire(self, mime_type: str) -> Dict[str, str]:
+        """取出一个可用的预签名 URL；池为空或 URL 即将过期时回退为即时请求。"""
+        pool = self.pools.get(mime_type)
+        if pool is None or self._task is None:
+            return await self.fetch(mime_type)
+        now = time.time()
+        while pool:
+            expires_at, data = pool.popleft()
+            if expires_at - self.margin > now:
+                self.hits += 1
+                self._wakeup.set()
+                return data
+            self.expired += 1
+            self.targets[mime_type] = max(0, self.targets[mime_type] - 1)
+        self.misses += 1
+        self.targets[mime_type] = min(self.max_size, self.targets[mime_type] + 1)
+        self._wakeup.set()
+        return await self.fetch(mime_type)
+
+    def _purge_expired(self):
+        now = time.time()
+        for mime_type, pool in self.pools.items():
+            while pool and pool[0][0] - self.margin <= now:
+                pool.popleft()
+                self.expired += 1
+                self.targets[mime_type] = max(0, self.targets[mime_type] - 1)
+
+    async def _refill_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.REFILL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._purge_expired()
+            for mime_type, pool in self.pools.items():
+                while len(pool) < self.targets[mime_type]:
+                    try:
+                        data = await self.fetch(mime_type)
+                    except Exception as e:
+                        logger.warning(f"预取 {mime_type} 签名 URL 失败: {e}")
+                        break
+                    pool.append((self._expires_at(data["url"]), data))
+                    self.fetched += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pooled": sum(len(pool) for pool in self.pools.values()), "hits": self.hits, "misses": self.misses,
+            "expired": self.expired, "fetched": self.fetched,
+        }
@@ -1,10 +1,21 @@
 # app/utils/sse_utils.py
+import asyncio
 import json
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, AsyncIterator
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，缺失时回退到标准库
+    orjson = None
 
 DONE_CHUNK = b"data: [DONE]\n\n"
 
+def _dumps_bytes(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
 def create_sse_data(data: Dict[str, Any]) -> bytes:
     """将字典数据格式化为 SSE 事件字符串。"""
     return f"data: {json.dumps(data)}\n\n".encode('utf-8')
@@ -31,3 +42,115 @@ def create_chat_completion_chunk(
             }
         ]
     }
+
+def create_chat_completion(
+    request_id: str,
+    model: str,
+    content: str,
+    usage: Dict[str, int],
+    finish_reason: str = "stop",
+    created: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    创建一个与 OpenAI 兼容的非流式聊天补全对象。
+    """
+    return {
+        "id": request_id,
+        "object": "chat.completion",
+        "created": int(time.time()) if created is None else created,
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": finish_reason
+            }
+        ],
+        "usage": usage
+    }
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：非 ASCII 字符 (中文等) 每个约 1 个 token，ASCII 文本约 4 个字符 1 个 token。"""
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return len(text) - ascii_chars + (ascii_chars + 3) // 4
+
+class ChatCompletionChunkEncoder:
+    """
+    单个请求的 SSE 编码器。
+    id / model / created 在构造时序列化为固定的字节前缀和后缀，之后每个增量只需对 content 做 JSON 转义，
+    输出与 create_sse_data(create_chat_completion_chunk(...)) 结构一致。
+    """
+
+    def __init__(self, request_id: str, model: str, created: Optional[int] = None):
+        self.request_id = request_id
+        self.model = model
+        self.created = int(time.time()) if created is None else created
+        self._prefix = (
+            b'data: {"id": ' + _dumps_bytes(request_id) +
+            b', "object": "chat.completion.chunk", "created": ' + str(self.created).encode('ascii') +
+            b', "model": ' + _dumps_bytes(model) +
+            b', "choices": [{"index": 0, "delta": {"content": '
+        )
+        self._suffix = b'}, "finish_reason": null}]}\n\n'
+
+    def encode(self, content: str) -> bytes:
+        return b"".join((self._prefix, _dumps_bytes(content), self._suffix))
+
+    def finish(self, finish_reason: str = "stop") -> bytes:
+        chunk = create_chat_completion_chunk(self.request_id, self.model, "", finish_reason)
+        chunk["created"] = self.created
+        return create_sse_data(chunk)
+
+async def coalesce_text(source: AsyncIterator[str], max_delay: float, max_chars: int) -> AsyncIterator[str]:
+    """
+    合并在 max_delay 秒时间窗口内到达的上游文本块，累计达到 max_chars 个字符时立即输出。
+    max_delay <= 0 时原样透传。结束 (包括被 aclose / 取消) 时关闭 source。
+    """
+    iterator = source.__aiter__()
+    if max_delay <= 0:
+        try:
+            async for text in iterator:
+                yield text
+        finally:
+            if hasattr(iterator, "aclose"): await iterator.aclose()
+        return
+
+    loop = asyncio.get_running_loop()
+    pending: Optional[asyncio.Future] = None
+    buffer = []
+    size = 0
+    deadline = 0.0
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                yield "".join(buffer)
+                buffer, size = [], 0
+                continue
+            future, pending = pending, None
+            try:
+                text = future.result()
+            except StopAsyncIteration:
+                break
+            if not buffer:
+                deadline = loop.time() + max_delay
+            buffer.append(text)
+            size += len(text)
+            if size >= max_chars:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            # 等待被取消的读取真正退出 source，否则 aclose 会报 "asynchronous generator is already running"，
+            # 且读取可能在上游响应关闭时仍停留在 aiter_bytes 中
+            await asyncio.wait((pending,))
+            if not pending.cancelled(): pending.exception()
+        if hasattr(iterator, "aclose"): await iterator.aclose()
@@ -0,0 +1,169 @@
+# app/utils/static_assets.py
+import asyncio
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli 已列入 requirements.txt，未安装时只提供 gzip 版本
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+TEXT_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class StaticAsset:
+    """一个静态文件在内存中的全部表示: 原始内容与预压缩版本 (只保留比原文件小的)，以及各自的强 ETag。"""
+
+    __slots__ = ("path", "mtime_ns", "size", "content_type", "cache_control", "variants", "etags")
+
+    def __init__(self, path: str, data: bytes, mtime_ns: int, cache_control: str):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = len(data)
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        compressible = content_type.startswith(TEXT_TYPES)
+        if compressible and content_type.startswith(("text/", "application/javascript")):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.cache_control = cache_control
+        digest = hashlib.sha256(data).hexdigest()[:20]
+        self.variants: Dict[str, bytes] = {"identity": data}
+        if compressible:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data): self.variants["gzip"] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data): self.variants["br"] = compressed
+        # 强 ETag 按表示区分，同一内容的不同编码不能共用
+        self.etags = {encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"' for encoding in self.variants}
+
+
+def parse_accept_encoding(header: str) -> List[str]:
+    """返回客户端可接受 (q > 0) 的编码名称。"""
+    accepted = []
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0: continue
+            except ValueError:
+                continue
+        if name: accepted.append(name.strip().lower())
+    return accepted
+
+
+class StaticAssetCache:
+    """
+    UI 静态文件的内存缓存。
+    启动时一次性读入 directory 下的所有文件并预先计算 gzip / brotli 版本，请求时不再访问磁盘也不做压缩；
+    后台任务每隔 reload_interval 秒检查文件修改时间，文件变化后重新加载，0 表示只在启动时加载。
+    扫描目录、读文件与压缩都在线程池中进行，不阻塞事件循环。
+    响应带强 ETag、Cache-Control 与 Vary: Accept-Encoding，If-None-Match 命中时返回 304。
+    """
+
+    def __init__(self, directory: str, max_age: int = 3600, html_cache_control: str = "no-cache", reload_interval: float = 2.0):
+        self.directory = directory
+        self.max_age = max_age
+        self.html_cache_control = html_cache_control
+        self.reload_interval = reload_interval
+        self.assets: Dict[str, StaticAsset] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.not_modified = 0
+        self.reloads = 0
+
+    def _cache_control(self, path: str) -> str:
+        if path.endswith(".html"): return self.html_cache_control
+        return f"public, max-age={self.max_age}"
+
+    def _scan(self) -> Dict[str, Tuple[str, int]]:
+        files = {}
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                full_path = os.path.join(root, name)
+                rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                try:
+                    files[rel_path] = (full_path, os.stat(full_path).st_mtime_ns)
+                except OSError:
+                    continue
+        return files
+
+    def load(self):
+        """(重新) 加载目录，只读取新增或修改过的文件。同步执行，在线程池中调用。"""
+        assets = {}
+        changed = 0
+        for rel_path, (full_path, mtime_ns) in self._scan().items():
+            asset = self.assets.get(rel_path)
+            if asset is None or asset.mtime_ns != mtime_ns:
+                try:
+                    with open(full_path, "rb") as f:
+                        asset = StaticAsset(rel_path, f.read(), mtime_ns, self._cache_control(rel_path))
+                except OSError as e:
+                    logger.warning("读取静态文件 %s 失败: %s", full_path, e)
+                    continue
+                changed += 1
+            assets[rel_path] = asset
+        if changed or len(assets) != len(self.assets):
+            if self.assets: self.reloads += 1
+            logger.info("已加载 %d 个静态文件 (%d 个有变化，brotli %s)。", len(assets), changed, "可用" if brotli else "不可用")
+        # 整体替换而不是原地修改，请求处理中读到的总是完整的一版
+        self.assets = assets
+
+    async def start(self):
+        await asyncio.to_thread(self.load)
+        if self.reload_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await asyncio.to_thread(self.load)
+            except Exception as e:
+                logger.warning("检查静态文件变化失败: %s", e)
+
+    def get(self, path: str) -> Optional[StaticAsset]:
+        return self.assets.get(path)
+
+    def response(self, path: str, headers: Mapping[str, str]) -> Optional[Response]:
+        """按请求头协商编码并返回响应；文件不存在时返回 None。"""
+        asset = self.get(path)
+        if asset is None: return None
+        accepted = parse_accept_encoding(headers.get("accept-encoding", ""))
+        encoding = next((name for name in ("br", "gzip") if name in asset.variants and name in accepted), "identity")
+        response_headers = {"ETag": asset.etags[encoding], "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if_none_match = headers.get("if-none-match")
+        if if_none_match:
+            # 弱比较: 忽略 W/ 前缀 (反向代理重新压缩时会弱化 ETag)，同一内容的任一编码版本都算命中
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or not tags.isdisjoint(asset.etags.values()):
+                self.not_modified += 1
+                return Response(status_code=304, headers=response_headers)
+        self.hits += 1
+        if encoding != "identity": response_headers["Content-Encoding"] = encoding
+        # HEAD 请求由服务器丢弃响应体，只保留 Content-Length 等头
+        return Response(content=asset.variants[encoding], headers=response_headers, media_type=asset.content_type)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "files": len(self.assets), "bytes": sum(sum(len(v) for v in asset.variants.values()) for asset in self.assets.values()),
+            "hits": self.hits, "not_modified": self.not_modified, "reloads": self.reloads,
+        }
@@ -0,0 +1,65 @@
+# app/utils/stream_parser.py
+import codecs
+from typing import List, Optional
+
+VISUAL_OPEN_TAG = "<visual"
+VISUAL_CLOSE_TAG = "</visual>"
+
+
+def create_utf8_decoder() -> codecs.IncrementalDecoder:
+    """创建增量 UTF-8 解码器，多字节字符被拆分到两个上游块时会等待后续字节再解码。"""
+    return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+class VisualBlockScanner:
+    """
+    流式 `<visual>` 块扫描器。
+    仅缓存当前尚未闭合的 visual 块（以及块外最多 len("<visual") - 1 个字符的标签前缀），
+    每当闭合标签到达即返回完整的块，内存占用以最大的单个 visual 块为上限。
+    """
+
+    def __init__(self):
+        self._pending = ""
+        self._parts: Optional[List[str]] = None
+        self._carry = ""
+
+    @staticmethod
+    def _partial_prefix(text: str, tag: str) -> str:
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if tag.startswith(text[-size:]):
+                return text[-size:]
+        return ""
+
+    def feed(self, text: str) -> List[str]:
+        """输入一段文本，返回本次输入中闭合的所有完整 visual 块。"""
+        blocks = []
+        data = text
+        while data:
+            if self._parts is None:
+                window = self._pending + data
+                start = window.find(VISUAL_OPEN_TAG)
+                if start < 0:
+                    self._pending = self._partial_prefix(window, VISUAL_OPEN_TAG)
+                    break
+                self._pending = ""
+                self._parts = []
+                self._carry = ""
+                data = window[start:]
+            else:
+                window = self._carry + data
+                index = window.find(VISUAL_CLOSE_TAG)
+                if index < 0:
+                    self._parts.append(data)
+                    self._carry = window[-(len(VISUAL_CLOSE_TAG) - 1):]
+                    break
+                end = index + len(VISUAL_CLOSE_TAG) - len(self._carry)
+                self._parts.append(data[:end])
+                blocks.append("".join(self._parts))
+                self._parts = None
+                self._carry = ""
+                data = data[end:]
+        return blocks
+
+    @property
+    def in_block(self) -> bool:
+        return self._parts is not None
@@ -0,0 +1,98 @@
+# app/utils/upload_cache.py
+import asyncio
+import hashlib
+from typing import Dict, Any, Awaitable, Callable, Mapping, Optional
+
+from cachetools import TTLCache
+
+
+def data_url_cache_key(url: str) -> str:
+    """Base64 数据 URL 按内容哈希，无需先解码即可判断是否已上传过。"""
+    return "sha256:" + hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def remote_url_validator(headers: Mapping[str, str]) -> Optional[Dict[str, str]]:
+    """远程文件的缓存校验器 (ETag / Last-Modified)，都没有时返回 None，此时不缓存该文件。"""
+    validator = {name: headers[name] for name in ("etag", "last-modified") if headers.get(name)}
+    return validator or None
+
+
+def remote_url_cache_key(url: str, validator: Dict[str, str]) -> str:
+    """远程 URL 按地址 + 校验器缓存，源文件变化 (ETag / Last-Modified 改变) 后不会命中旧的上传结果。"""
+    return f"url:{url}#{validator.get('etag', '')}#{validator.get('last-modified', '')}"
+
+
+def conditional_headers(validator: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """按上次记录的校验器构造条件请求头，源文件未变化时服务器返回 304 而不发送内容。"""
+    if not validator: return {}
+    if "etag" in validator: return {"If-None-Match": validator["etag"]}
+    return {"If-Modified-Since": validator["last-modified"]}
+
+
+class UploadCache:
+    """
+    内容寻址的上传结果缓存 (TTL + LRU)，值为 `{type, content, card_id, file_name}` 文件消息。
+    相同 key 的并发上传只会真正执行一次，其余请求等待同一个进行中的任务 (single-flight)。
+    远程 URL 另外记录最近一次的校验器，供下次下载时发起条件请求。
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.validators: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.revalidated = 0
+        self.bytes_saved = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """只查缓存，不发起上传；用于条件请求返回 304 时取回上次的上传结果。"""
+        cached = self.cache.get(key)
+        if cached is None: return None
+        self.hits += 1
+        self.revalidated += 1
+        return dict(cached)
+
+    async def get_or_upload(self, key: str, upload: Callable[[], Awaitable[Dict[str, Any]]], size: int = 0) -> Dict[str, Any]:
+        while True:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.hits += 1
+                self.bytes_saved += size
+                return dict(cached)
+            inflight = self.inflight.get(key)
+            if inflight is None:
+                break
+            try:
+                result = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled(): raise
+                continue  # 发起上传的请求被取消，由当前请求重新发起
+            self.shared += 1
+            self.bytes_saved += size
+            return dict(result)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            result = await upload()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # 标记异常已被读取，避免无人等待时的警告
+            raise
+        finally:
+            self.inflight.pop(key, None)
+        self.cache[key] = result
+        future.set_result(result)
+        return dict(result)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.cache), "hits": self.hits, "misses": self.misses,
+            "shared": self.shared, "revalidated": self.revalidated, "bytes_saved": self.bytes_saved,
+        }
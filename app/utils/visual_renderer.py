@@ -0,0 +1,216 @@
+# app/utils/visual_renderer.py
+import asyncio
+import hashlib
+import math
+import re
+import time
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+from xml.etree import ElementTree as ET
+
+from cachetools import LRUCache
+
+from app.core.metrics import RENDER_DURATION
+
+logger = logging.getLogger(__name__)
+
+_XMLNS_PATTERN = re.compile(r'\sxmlns="[^"]+"')
+_HEADING_PATTERN = re.compile(r'^(#+)\s*(.*)')
+
+_ICONS = {1: "🌊", 2: "📚", 3: "🚫"}
+
+# 预先拼好的 HTML 片段，渲染时只拼接动态部分
+_HTML_HEAD = '<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>'
+_MINDMAP_STYLE = '</title><style>body{font-family:sans-serif;background:linear-gradient(135deg,#667eea 0%,#764ba2 100%);padding:20px;display:flex;justify-content:center;align-items:center;} .container{background:white;border-radius:20px;box-shadow:0 20px 60px rgba(0,0,0,0.3);padding:40px;max-width:1200px;} .title{text-align:center;color:#2c3e50;font-size:2.5em;margin-bottom:30px;} .mindmap{display:flex;justify-content:center;align-items:center;gap:60px;} .center-node{background:linear-gradient(135deg,#3498db,#2980b9);color:white;padding:30px;border-radius:15px;font-size:1.8em;text-align:center;box-shadow:0 10px 30px rgba(52,152,219,0.3);z-index:10;} .branches{display:flex;flex-direction:column;gap:30px;} .branch{background:#f8f9fa;border-radius:15px;padding:25px;box-shadow:0 5px 20px rgba(0,0,0,0.1);border-left:5px solid #3498db;} .branch-title{color:#2c3e50;font-size:1.4em;font-weight:bold;margin-bottom:15px;display:flex;align-items:center;gap:10px;} .branch-icon{width:30px;height:30px;background:#3498db;border-radius:50%;display:flex;align-items:center;justify-content:center;color:white;font-size:1.2em;flex-shrink:0;} .sub-items{display:flex;flex-direction:column;gap:15px;} .sub-item{background:white;padding:15px 20px;border-radius:10px;border-left:3px solid #e74c3c;box-shadow:0 2px 10px rgba(0,0,0,0.05);} .pulse{animation:pulse 2s infinite;} @keyframes pulse{0%{box-shadow:0 10px 30px rgba(52,152,219,0.3);}50%{box-shadow:0 10px 40px rgba(52,152,219,0.5);}100%{box-shadow:0 10px 30px rgba(52,152,219,0.3);}} @media (max-width:992px){.mindmap{flex-direction:column;} .branches{width:100%;}}</style></head><body><div class="container"><h1 class="title">🌊 '
+_MINDMAP_BODY = '</h1><div class="mindmap">'
+_MINDMAP_TAIL = '</div></div></body></html>'
+_FLOWCHART_STYLE_WIDTH = '</title><style>body{background:#f0f2f5;} .flowchart{position:relative;width:'
+_FLOWCHART_STYLE_HEIGHT = 'px;height:'
+_FLOWCHART_STYLE_BODY = 'px;margin:auto;background-image:linear-gradient(45deg,#e9ecef 25%,transparent 25%),linear-gradient(-45deg,#e9ecef 25%,transparent 25%),linear-gradient(45deg,transparent 75%,#e9ecef 75%),linear-gradient(-45deg,transparent 75%,#e9ecef 75%);background-size:20px 20px;border:1px solid #dee2e6;} .box{position:absolute;padding:10px;border:2px solid #343a40;background-color:#fff;text-align:center;box-shadow:0 2px 4px rgba(0,0,0,0.05);display:flex;align-items:center;justify-content:center;} .shape_circle{border-radius:50%;} .shape_rectangle{border-radius:8px;} .border_blue{border-color:#4a90e2;} .border_green{border-color:#7ed321;} .border_yellow{border-color:#f5a623;} .border_purple{border-color:#9013fe;} .border_orange{border-color:#f88010;} .line{position:absolute;background-color:#808080;width:2px;transform-origin:top center;}</style></head><body><div class="flowchart">'
+_FLOWCHART_TAIL = '</div></body></html>'
+
+
+def _icon(level: int) -> str:
+    return _ICONS.get(level, "📌")
+
+
+def markdown_to_tree(content: str) -> List[Dict[str, Any]]:
+    nodes = []
+    for line in content.split('\n'):
+        line = line.strip()
+        if not line: continue
+        match = _HEADING_PATTERN.match(line)
+        if match:
+            nodes.append({'level': len(match.group(1)), 'text': match.group(2).strip(), 'description': [], 'children': []})
+        elif nodes:
+            nodes[-1]['description'].append(line)
+    if not nodes: return []
+    root_node = nodes.pop(0)
+    tree = {'text': root_node['text'], 'description': ' '.join(root_node['description']), 'children': [], 'level': root_node['level']}
+    stack = [tree]
+    for node in nodes:
+        current = {'text': node['text'], 'description': ' '.join(node['description']), 'children': [], 'level': node['level']}
+        while len(stack) > 1 and stack[-1]['level'] >= node['level']: stack.pop()
+        stack[-1]['children'].append(current)
+        stack.append(current)
+    return [tree]
+
+
+def generate_mindmap_html(tree_data: List[Dict[str, Any]], title: str = "思维导图") -> str:
+    center = tree_data[0] if tree_data else {'text': '中心主题', 'description': '', 'children': []}
+    parts = [_HTML_HEAD, title, _MINDMAP_STYLE, title, _MINDMAP_BODY, '<div class="center-node pulse"><div class="node-title">', center["text"], '</div>']
+    if center.get('description'): parts += ('<div class="node-desc">', center["description"], '</div>')
+    parts.append("</div><div class='branches'>")
+    branch_icon = _icon(1)
+    sub_icon = _icon(2)
+    for branch in center.get('children', []):
+        parts += ('<div class="branch"><div class="branch-title"><div class="branch-icon">', branch_icon, '</div>', branch["text"], '</div>')
+        if branch.get('description'): parts += ('<div class="branch-description">', branch["description"], '</div>')
+        children = branch.get('children', [])
+        if children:
+            parts.append('<div class="sub-items">')
+            for child in children:
+                parts += ('<div class="sub-item"><div class="sub-item-title">', sub_icon, ' ', child["text"], '</div>')
+                if child.get('description'): parts += ('<div class="sub-item-description">', child["description"], '</div>')
+                parts.append('</div>')
+            parts.append('</div>')
+        parts.append('</div>')
+    parts += ('</div>', _MINDMAP_TAIL)
+    return "".join(parts)
+
+
+def generate_flowchart_html(root: ET.Element) -> str:
+    title = root.get('title', '流程图')
+    nodes = {elem.get('id'): elem for elem in root.findall('text')}
+    parts = [
+        _HTML_HEAD, title, _FLOWCHART_STYLE_WIDTH, root.get('width', '1000'),
+        _FLOWCHART_STYLE_HEIGHT, root.get('height', '800'), _FLOWCHART_STYLE_BODY,
+    ]
+    for elem in nodes.values():
+        text_content = (elem.text or "").strip().replace('\n', '<br>')
+        parts.append(
+            f"<div class='box {elem.get('style', '')} shape_{elem.get('shape', 'rectangle')}' style='left:{elem.get('x')}px; top:{elem.get('y')}px; "
+            f"width:{elem.get('width')}px; height:{elem.get('height')}px;'><div>{text_content}</div></div>"
+        )
+
+    # 每个节点的连线锚点 (底边中点 / 顶边中点) 只计算一次
+    anchors: Dict[str, tuple] = {}
+    def anchor(node_id: str, elem: ET.Element) -> tuple:
+        point = anchors.get(node_id)
+        if point is None:
+            x = float(elem.get('x')) + float(elem.get('width')) / 2
+            y = float(elem.get('y'))
+            point = anchors[node_id] = (x, y + float(elem.get('height')), y)
+        return point
+
+    sqrt, atan2, degrees = math.sqrt, math.atan2, math.degrees
+    for line in root.findall('line'):
+        start_id, end_id = line.get('start-node'), line.get('end-node')
+        start_node, end_node = nodes.get(start_id), nodes.get(end_id)
+        if start_node is not None and end_node is not None:
+            x1, y1, _ = anchor(start_id, start_node)
+            x2, _, y2 = anchor(end_id, end_node)
+            length = sqrt((x2 - x1)**2 + (y2 - y1)**2)
+            angle = degrees(atan2(y2 - y1, x2 - x1)) - 90
+            parts.append(f"<div class='line' style='height:{length}px; left:{x1}px; top:{y1}px; transform:rotate({angle}deg);'></div>")
+    parts.append(_FLOWCHART_TAIL)
+    return "".join(parts)
+
+
+def render_visual_html(xml_content: str) -> str:
+    """解析一次 visual XML 并按类型渲染为 HTML 页面；出错时返回错误说明页面。"""
+    try:
+        root = ET.fromstring(_XMLNS_PATTERN.sub('', xml_content, count=1))
+        visual_type = root.get("type", "")
+        if 'mindmap' in visual_type:
+            tree_data = markdown_to_tree("".join(root.itertext()).strip())
+            return generate_mindmap_html(tree_data, root.get('title', '思维导图'))
+        elif 'flowchart' in visual_type:
+            return generate_flowchart_html(root)
+        else:
+            # 提供一个后备的简单渲染
+            return f"<h1>未知图表类型</h1><pre>{ET.tostring(root, encoding='unicode')}</pre>"
+    except Exception as e:
+        logger.error(f"生成HTML时出错: {e}", exc_info=True)
+        return f"<h1>HTML Generation Error</h1><p>{e}</p>"
+
+
+class VisualRenderer:
+    """
+    带 LRU 缓存的 visual 渲染器，以 XML 内容的 SHA-256 为 key，重复的图表直接返回缓存的 HTML。
+    render_async 把渲染放到线程池或进程池中执行，避免大型图表阻塞事件循环；
+    超过 max_xml_bytes 或 timeout 秒内未完成时返回 None，由调用方降级输出原始 XML。
+    """
+
+    def __init__(self, maxsize: int, executor: str = "inline", workers: int = 2, timeout: float = 5.0, max_xml_bytes: int = 1024 * 1024):
+        self.cache: Optional[LRUCache] = LRUCache(maxsize=maxsize) if maxsize > 0 else None
+        self.timeout = timeout
+        self.max_xml_bytes = max_xml_bytes
+        executor = executor.lower()
+        if executor == "process":
+            self.executor: Optional[Executor] = ProcessPoolExecutor(max_workers=workers)
+        elif executor == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="visual-render")
+        elif executor == "inline":
+            self.executor = None
+        else:
+            raise ValueError(f"未知的渲染执行器: {executor}")
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.oversized = 0
+
+    @staticmethod
+    def cache_key(xml_content: str) -> str:
+        return hashlib.sha256(xml_content.encode("utf-8")).hexdigest()
+
+    def render(self, xml_content: str) -> str:
+        if self.cache is None:
+            return render_visual_html(xml_content)
+        key = self.cache_key(xml_content)
+        html = self.cache.get(key)
+        if html is not None:
+            self.hits += 1
+            return html
+        self.misses += 1
+        html = self.cache[key] = render_visual_html(xml_content)
+        return html
+
+    async def render_async(self, xml_content: str) -> Optional[str]:
+        data = xml_content.encode("utf-8")
+        if len(data) > self.max_xml_bytes:
+            self.oversized += 1
+            return None
+        key = hashlib.sha256(data).hexdigest()
+        if self.cache is not None:
+            html = self.cache.get(key)
+            if html is not None:
+                self.hits += 1
+                return html
+        self.misses += 1
+        started = time.perf_counter()
+        if self.executor is None:
+            html = render_visual_html(xml_content)
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, render_visual_html, xml_content)
+            try:
+                html = await asyncio.wait_for(future, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                # 已开始执行的渲染无法中断，只能放弃其结果；尚在排队的任务会被取消
+                self.timeouts += 1
+                return None
+        RENDER_DURATION.observe(time.perf_counter() - started)
+        if self.cache is not None:
+            self.cache[key] = html
+        return html
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.cache) if self.cache is not None else 0, "hits": self.hits, "misses": self.misses,
+            "timeouts": self.timeouts, "oversized": self.oversized,
+        }
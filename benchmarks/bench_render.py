@@ -0,0 +1,61 @@
+# benchmarks/bench_render.py
+"""
+图表渲染微基准: 生成一个大型流程图和一个多层思维导图，分别测量优化前的实现 (legacy_render.py)、
+当前实现的首次渲染与 LRU 命中时的耗时。
+
+    python -m benchmarks.bench_render --nodes 600 --repeat 50
+"""
+import argparse
+import random
+import time
+
+from app.utils.visual_renderer import VisualRenderer, render_visual_html
+from benchmarks.legacy_render import convert_visual_to_html
+
+
+def build_flowchart(nodes: int, seed: int = 1) -> str:
+    rng = random.Random(seed)
+    texts = "".join(
+        f'<text id="n{i}" x="{rng.randint(0, 1800)}" y="{rng.randint(0, 1800)}" width="120" height="40" '
+        f'style="border_blue" shape="rectangle">节点 {i}\n说明</text>'
+        for i in range(nodes)
+    )
+    lines = "".join(f'<line start-node="n{rng.randrange(nodes)}" end-node="n{rng.randrange(nodes)}"/>' for _ in range(nodes * 2))
+    return f'<visual type="flowchart" title="大型流程图" width="2000" height="2000" xmlns="http://www.mymap.ai">{texts}{lines}</visual>'
+
+
+def build_mindmap(branches: int) -> str:
+    body = "\n".join(
+        f"## 分支 {i}\n分支说明 {i}\n" + "\n".join(f"### 子项 {i}.{j}\n子项说明" for j in range(5))
+        for i in range(branches)
+    )
+    return f'<visual type="mindmap" title="思维导图" xmlns="http://www.mymap.ai">\n# 中心主题\n中心说明\n{body}\n</visual>'
+
+
+def measure(label: str, func, repeat: int, baseline: float = 0.0) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    speedup = f"{baseline / elapsed:8.2f}x" if baseline else ""
+    print(f"{label:<32} {elapsed * 1000:10.3f} ms {speedup}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="visual 渲染微基准")
+    parser.add_argument("--nodes", type=int, default=600, help="流程图节点数 (连线数为其两倍)")
+    parser.add_argument("--branches", type=int, default=100, help="思维导图分支数")
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    for name, xml in (("flowchart", build_flowchart(args.nodes)), ("mindmap", build_mindmap(args.branches))):
+        renderer = VisualRenderer(maxsize=16)
+        renderer.render(xml)
+        baseline = measure(f"{name} 优化前 ({len(xml) // 1024} KB XML)", lambda: convert_visual_to_html(xml), args.repeat)
+        measure(f"{name} 渲染", lambda: render_visual_html(xml), args.repeat, baseline)
+        measure(f"{name} LRU 命中", lambda: renderer.render(xml), args.repeat, baseline)
+
+
+if __name__ == "__main__":
+    main()
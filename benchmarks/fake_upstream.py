@@ -0,0 +1,103 @@
+# benchmarks/fake_upstream.py
+"""
+mymap.ai 的本地替身，供压测使用，实现代理依赖的三个上游接口:
+
+- POST /sapi/aichat   按配置的速率分块流式输出回复，响应头带 x-chat-id，可附带 <visual> 思维导图 / 流程图
+- POST /sapi/query    getSignedUrl，返回指向本服务 /s3/ 的预签名 URL
+- PUT  /s3/{key}      S3 风格的上传接收端，只统计字节数，不保存内容
+
+通过环境变量配置:
+    FAKE_TOKENS        每个回复的文本块数 (默认 200)
+    FAKE_TOKEN_RATE    每秒输出的块数，0 表示不限速 (默认 50)
+    FAKE_VISUAL        none / mindmap / flowchart / mixed (默认 mixed)
+    FAKE_FLOWCHART_NODES  流程图节点数 (默认 50)
+    FAKE_TTFB_MS       首个字节前的模拟延迟 (默认 50)
+
+    uvicorn benchmarks.fake_upstream:app --port 9100
+"""
+import asyncio
+import itertools
+import os
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from benchmarks.bench_render import build_flowchart, build_mindmap
+
+TOKENS = int(os.getenv("FAKE_TOKENS", "200"))
+TOKEN_RATE = float(os.getenv("FAKE_TOKEN_RATE", "50"))
+VISUAL = os.getenv("FAKE_VISUAL", "mixed")
+FLOWCHART_NODES = int(os.getenv("FAKE_FLOWCHART_NODES", "50"))
+TTFB = int(os.getenv("FAKE_TTFB_MS", "50")) / 1000
+
+_WORDS = ["思维", "导图", "mymap", " ", "流程", "stream", "，", "token", "。", "\n"]
+_VISUALS = {
+    "mindmap": build_mindmap(10),
+    "flowchart": build_flowchart(FLOWCHART_NODES),
+}
+_visual_cycle = itertools.cycle(("mindmap", "flowchart", None))
+
+app = FastAPI(title="fake-mymap-upstream")
+stats = {"chats": 0, "signed_urls": 0, "uploads": 0, "upload_bytes": 0}
+
+
+def _pick_visual():
+    if VISUAL == "mixed":
+        return next(_visual_cycle)
+    return VISUAL if VISUAL in _VISUALS else None
+
+
+async def _reply():
+    await asyncio.sleep(TTFB)
+    delay = 1 / TOKEN_RATE if TOKEN_RATE > 0 else 0
+    visual = _pick_visual()
+    visual_at = TOKENS // 2 if visual else -1
+    for i in range(TOKENS):
+        yield _WORDS[i % len(_WORDS)].encode("utf-8")
+        if i == visual_at:
+            yield f"\n{_VISUALS[visual]}\n".encode("utf-8")
+        if delay: await asyncio.sleep(delay)
+
+
+@app.head("/")
+@app.get("/")
+async def root():
+    return Response()
+
+
+@app.post("/sapi/aichat")
+async def aichat(request: Request):
+    payload = await request.json()
+    stats["chats"] += 1
+    chat_id = payload.get("id") or uuid.uuid4().hex
+    return StreamingResponse(_reply(), media_type="text/plain; charset=utf-8", headers={"x-chat-id": chat_id})
+
+
+@app.post("/sapi/query")
+async def query(request: Request):
+    payload = await request.json()
+    if payload.get("operationName") != "getSignedUrl":
+        return JSONResponse({"errors": [{"message": "unsupported operation"}]})
+    stats["signed_urls"] += 1
+    file_id = uuid.uuid4().hex
+    signed_at = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    url = f"{str(request.base_url).rstrip('/')}/s3/{file_id}?X-Amz-Date={signed_at}&X-Amz-Expires=900"
+    content_type = payload["variables"]["input"]["type"]
+    return JSONResponse({"data": {"getSignedUrl": {"url": url, "id": file_id, "type": content_type, "__typename": "SignedUrl"}}})
+
+
+@app.put("/s3/{key}")
+async def s3_put(key: str, request: Request):
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    stats["uploads"] += 1
+    stats["upload_bytes"] += size
+    return Response(headers={"ETag": f'"{key}"'})
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
@@ -0,0 +1,124 @@
+# benchmarks/legacy_render.py
+"""
+基准对照: 优化前 (baseline 提交中 MyMapProvider._convert_visual_to_html 及其辅助方法) 的渲染实现，
+原样冻结为模块级函数 (仅去掉 self)，供 bench_render.py 对比。不要修改。
+"""
+import logging
+import math
+import re
+from xml.etree import ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_mindmap_xml(xml_content):
+    xml_content = re.sub(r'\sxmlns="[^"]+"', '', xml_content, count=1)
+    root = ET.fromstring(xml_content)
+    title = root.get('title', '思维导图')
+    content = "".join(root.itertext()).strip()
+    return {'title': title, 'content': content}
+
+
+def _markdown_to_tree(content):
+    lines = content.split('\n')
+    nodes = []
+    for line in lines:
+        line = line.strip()
+        if not line: continue
+        match = re.match(r'^(#+)\s*(.*)', line)
+        if match:
+            level = len(match.group(1))
+            text = match.group(2).strip()
+            nodes.append({'level': level, 'text': text, 'description': '', 'children': []})
+        elif nodes:
+            nodes[-1]['description'] += f' {line}'
+    if not nodes: return []
+    root_node = nodes.pop(0)
+    tree = {'text': root_node['text'], 'description': root_node['description'].strip(), 'children': [], 'level': root_node['level']}
+    stack = [tree]
+    for node in nodes:
+        current = {'text': node['text'], 'description': node['description'].strip(), 'children': [], 'level': node['level']}
+        while len(stack) > 1 and stack[-1]['level'] >= node['level']: stack.pop()
+        stack[-1]['children'].append(current)
+        stack.append(current)
+    return [tree]
+
+
+def _generate_mindmap_html(tree_data, title="思维导图"):
+    def get_icon(level): return {1: "🌊", 2: "📚", 3: "🚫"}.get(level, "📌")
+    def gen_children(children, level):
+        if not children: return ""
+        html = '<div class="sub-items">'
+        for child in children:
+            html += f'<div class="sub-item"><div class="sub-item-title">{get_icon(level)} {child["text"]}</div>'
+            if child.get('description'): html += f'<div class="sub-item-description">{child["description"]}</div>'
+            html += '</div>'
+        return html + '</div>'
+    def gen_branches(children, level):
+        if not children: return ""
+        html = ""
+        for child in children:
+            html += f'<div class="branch"><div class="branch-title"><div class="branch-icon">{get_icon(level)}</div>{child["text"]}</div>'
+            if child.get('description'): html += f'<div class="branch-description">{child["description"]}</div>'
+            html += gen_children(child.get('children', []), level + 1) + '</div>'
+        return html
+    center = tree_data[0] if tree_data else {'text': '中心主题', 'description': '', 'children': []}
+    center_html = f'<div class="center-node pulse"><div class="node-title">{center["text"]}</div>'
+    if center.get('description'): center_html += f'<div class="node-desc">{center["description"]}</div>'
+    center_html += '</div>'
+    branches_html = f"<div class='branches'>{gen_branches(center.get('children', []), 1)}</div>"
+    return f'<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>{title}</title><style>body{{font-family:sans-serif;background:linear-gradient(135deg,#667eea 0%,#764ba2 100%);padding:20px;display:flex;justify-content:center;align-items:center;}} .container{{background:white;border-radius:20px;box-shadow:0 20px 60px rgba(0,0,0,0.3);padding:40px;max-width:1200px;}} .title{{text-align:center;color:#2c3e50;font-size:2.5em;margin-bottom:30px;}} .mindmap{{display:flex;justify-content:center;align-items:center;gap:60px;}} .center-node{{background:linear-gradient(135deg,#3498db,#2980b9);color:white;padding:30px;border-radius:15px;font-size:1.8em;text-align:center;box-shadow:0 10px 30px rgba(52,152,219,0.3);z-index:10;}} .branches{{display:flex;flex-direction:column;gap:30px;}} .branch{{background:#f8f9fa;border-radius:15px;padding:25px;box-shadow:0 5px 20px rgba(0,0,0,0.1);border-left:5px solid #3498db;}} .branch-title{{color:#2c3e50;font-size:1.4em;font-weight:bold;margin-bottom:15px;display:flex;align-items:center;gap:10px;}} .branch-icon{{width:30px;height:30px;background:#3498db;border-radius:50%;display:flex;align-items:center;justify-content:center;color:white;font-size:1.2em;flex-shrink:0;}} .sub-items{{display:flex;flex-direction:column;gap:15px;}} .sub-item{{background:white;padding:15px 20px;border-radius:10px;border-left:3px solid #e74c3c;box-shadow:0 2px 10px rgba(0,0,0,0.05);}} .pulse{{animation:pulse 2s infinite;}} @keyframes pulse{{0%{{box-shadow:0 10px 30px rgba(52,152,219,0.3);}}50%{{box-shadow:0 10px 40px rgba(52,152,219,0.5);}}100%{{box-shadow:0 10px 30px rgba(52,152,219,0.3);}}}} @media (max-width:992px){{.mindmap{{flex-direction:column;}} .branches{{width:100%;}}}}</style></head><body><div class="container"><h1 class="title">🌊 {title}</h1><div class="mindmap">{center_html}{branches_html}</div></div></body></html>'
+
+
+# **【全新功能】** 流程图专用渲染器
+def _generate_flowchart_html(root: ET.Element):
+    title = root.get('title', '流程图')
+    width = root.get('width', '1000')
+    height = root.get('height', '800')
+    
+    nodes = {elem.get('id'): elem for elem in root.findall('text')}
+    boxes_html = ""
+    for elem_id, elem in nodes.items():
+        style = elem.get('style', '')
+        shape = elem.get('shape', 'rectangle')
+        text_content = (elem.text or "").strip().replace('\n', '<br>')
+        box_html = f"<div class='box {style} shape_{shape}' style='left:{elem.get('x')}px; top:{elem.get('y')}px; width:{elem.get('width')}px; height:{elem.get('height')}px;'><div>{text_content}</div></div>"
+        boxes_html += box_html
+    
+    lines_html = ""
+    for line in root.findall('line'):
+        start_node = nodes.get(line.get('start-node'))
+        end_node = nodes.get(line.get('end-node'))
+        if start_node is not None and end_node is not None:
+            x1 = float(start_node.get('x')) + float(start_node.get('width')) / 2
+            y1 = float(start_node.get('y')) + float(start_node.get('height'))
+            x2 = float(end_node.get('x')) + float(end_node.get('width')) / 2
+            y2 = float(end_node.get('y'))
+            
+            length = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+            angle = math.degrees(math.atan2(y2 - y1, x2 - x1)) - 90
+            
+            lines_html += f"<div class='line' style='height:{length}px; left:{x1}px; top:{y1}px; transform:rotate({angle}deg);'></div>"
+
+    return f'<!DOCTYPE html><html lang="zh-CN"><head><meta charset="UTF-8"><title>{title}</title><style>body{{background:#f0f2f5;}} .flowchart{{position:relative;width:{width}px;height:{height}px;margin:auto;background-image:linear-gradient(45deg,#e9ecef 25%,transparent 25%),linear-gradient(-45deg,#e9ecef 25%,transparent 25%),linear-gradient(45deg,transparent 75%,#e9ecef 75%),linear-gradient(-45deg,transparent 75%,#e9ecef 75%);background-size:20px 20px;border:1px solid #dee2e6;}} .box{{position:absolute;padding:10px;border:2px solid #343a40;background-color:#fff;text-align:center;box-shadow:0 2px 4px rgba(0,0,0,0.05);display:flex;align-items:center;justify-content:center;}} .shape_circle{{border-radius:50%;}} .shape_rectangle{{border-radius:8px;}} .border_blue{{border-color:#4a90e2;}} .border_green{{border-color:#7ed321;}} .border_yellow{{border-color:#f5a623;}} .border_purple{{border-color:#9013fe;}} .border_orange{{border-color:#f88010;}} .line{{position:absolute;background-color:#808080;width:2px;transform-origin:top center;}}</style></head><body><div class="flowchart">{boxes_html}{lines_html}</div></body></html>'
+
+
+# **【智能分发】** 根据类型调用不同的渲染器
+def convert_visual_to_html(xml_content):
+    try:
+        xml_content = re.sub(r'\sxmlns="[^"]+"', '', xml_content, count=1)
+        root = ET.fromstring(xml_content)
+        visual_type = root.get("type", "")
+
+        if 'mindmap' in visual_type:
+            data = _parse_mindmap_xml(xml_content)
+            tree_data = _markdown_to_tree(data['content'])
+            return _generate_mindmap_html(tree_data, data['title'])
+        elif 'flowchart' in visual_type:
+            return _generate_flowchart_html(root)
+        else:
+            # 提供一个后备的简单渲染
+            return f"<h1>未知图表类型</h1><pre>{ET.tostring(root, encoding='unicode')}</pre>"
+    except Exception as e:
+        logger.error(f"生成HTML时出错: {e}", exc_info=True)
+        return f"<h1>HTML Generation Error</h1><p>{e}</p>"
@@ -0,0 +1,200 @@
+# benchmarks/load_test.py
+"""
+对 /v1/chat/completions 的压测，结果以 JSON 输出，便于在不同提交之间对比。
+
+默认会在本机启动 benchmarks.fake_upstream 和指向它的代理 (uvicorn main:app)，
+再以给定并发发送流式请求，统计吞吐量、首字节时间与总耗时的 p50/p99、
+每个流消耗的代理进程 CPU 时间以及代理进程的峰值 RSS (需要 Linux /proc)。
+
+    python -m benchmarks.load_test --requests 200 --concurrency 20 --tokens 200 --image-ratio 0.2 --output result.json
+
+使用 --target 可以压测已经在运行的代理，此时不启动子进程，若同时给出 --pid 则仍统计该进程的 CPU 与内存。
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values: return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 3)
+
+
+def read_process_usage(pid: Optional[int]) -> Dict[str, Optional[float]]:
+    """从 /proc 读取进程累计 CPU 时间 (秒) 与峰值 RSS (MB)，非 Linux 平台返回 None。"""
+    if pid is None: return {"cpu_seconds": None, "peak_rss_mb": None}
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        peak_rss_mb = None
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak_rss_mb = int(line.split()[1]) / 1024
+        return {"cpu_seconds": cpu_seconds, "peak_rss_mb": peak_rss_mb}
+    except (OSError, ValueError, IndexError):
+        return {"cpu_seconds": None, "peak_rss_mb": None}
+
+
+def make_image_url(size: int, unique: bool) -> str:
+    seed = random.getrandbits(32) if unique else 0
+    data = b"\x89PNG\r\n\x1a\n" + random.Random(seed).randbytes(max(0, size - 8))
+    return "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+
+
+def build_request(index: int, args: argparse.Namespace, shared_image: Optional[str]) -> Dict[str, Any]:
+    content: Any = f"压测请求 {index}: 请生成一个思维导图。"
+    if random.random() < args.image_ratio:
+        image_url = make_image_url(args.image_size, True) if args.unique_images else shared_image
+        content = [{"type": "text", "text": content}, {"type": "image_url", "image_url": {"url": image_url}}]
+    return {"model": "mymap-ai", "stream": True, "user": f"bench-{index}", "messages": [{"role": "user", "content": content}]}
+
+
+async def run_one(client: httpx.AsyncClient, url: str, body: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    ttfb = None
+    size = 0
+    try:
+        async with client.stream("POST", url, json=body, headers=headers) as response:
+            async for chunk in response.aiter_bytes():
+                if ttfb is None: ttfb = time.perf_counter() - started
+                size += len(chunk)
+            ok = response.status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    return {"ok": ok, "ttfb": ttfb, "total": time.perf_counter() - started, "bytes": size}
+
+
+async def run_load(args: argparse.Namespace, target: str) -> Dict[str, Any]:
+    url = f"{target.rstrip('/')}/v1/chat/completions"
+    headers = {"Authorization": f"Bearer {args.api_key}"}
+    shared_image = make_image_url(args.image_size, False)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for i in range(args.warmup):
+            await run_one(client, url, build_request(-1 - i, args, shared_image), headers)
+        counter = iter(range(args.requests))
+        results: List[Dict[str, Any]] = []
+
+        async def worker():
+            for index in counter:
+                results.append(await run_one(client, url, build_request(index, args, shared_image), headers))
+
+        usage_before = read_process_usage(args.pid)
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        duration = time.perf_counter() - started
+        usage_after = read_process_usage(args.pid)
+
+    succeeded = [r for r in results if r["ok"]]
+    cpu = None
+    if usage_before["cpu_seconds"] is not None and usage_after["cpu_seconds"] is not None and results:
+        cpu = (usage_after["cpu_seconds"] - usage_before["cpu_seconds"]) / len(results)
+    ttfbs = [r["ttfb"] * 1000 for r in succeeded if r["ttfb"] is not None]
+    totals = [r["total"] * 1000 for r in succeeded]
+    return {
+        "requests": len(results), "errors": len(results) - len(succeeded), "duration_s": round(duration, 3),
+        "throughput_rps": round(len(succeeded) / duration, 3) if duration else None,
+        "bytes_received": sum(r["bytes"] for r in results),
+        "ttfb_ms": {"p50": percentile(ttfbs, 50), "p99": percentile(ttfbs, 99)},
+        "total_ms": {"p50": percentile(totals, 50), "p99": percentile(totals, 99)},
+        "cpu_ms_per_stream": round(cpu * 1000, 3) if cpu is not None else None,
+        "peak_rss_mb": usage_after["peak_rss_mb"],
+    }
+
+
+def spawn(module: str, port: int, env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, env={**os.environ, **env},
+    )
+
+
+def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500: return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"服务未在 {timeout} 秒内就绪: {url}")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mymap-2api 压测")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2, help="不计入统计的预热请求数")
+    parser.add_argument("--tokens", type=int, default=200, help="替身上游每个回复的文本块数")
+    parser.add_argument("--token-rate", type=float, default=50, help="替身上游每秒输出的块数，0 表示不限速")
+    parser.add_argument("--visual", default="mixed", choices=("none", "mindmap", "flowchart", "mixed"))
+    parser.add_argument("--flowchart-nodes", type=int, default=50)
+    parser.add_argument("--image-ratio", type=float, default=0.0, help="携带图片的请求比例")
+    parser.add_argument("--image-size", type=int, default=256 * 1024, help="图片字节数")
+    parser.add_argument("--unique-images", action="store_true", help="每个请求使用不同的图片 (默认相同，可命中上传缓存)")
+    parser.add_argument("--target", help="压测已运行的代理地址，不启动子进程")
+    parser.add_argument("--pid", type=int, help="配合 --target 统计该代理进程的 CPU 与内存")
+    parser.add_argument("--api-key", default="1")
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--proxy-port", type=int, default=9101)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="结果写入的 JSON 文件，默认输出到标准输出")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    processes: List[subprocess.Popen] = []
+    try:
+        target = args.target
+        if target is None:
+            upstream = f"http://127.0.0.1:{args.upstream_port}"
+            processes.append(spawn("benchmarks.fake_upstream:app", args.upstream_port, {
+                "FAKE_TOKENS": str(args.tokens), "FAKE_TOKEN_RATE": str(args.token_rate),
+                "FAKE_VISUAL": args.visual, "FAKE_FLOWCHART_NODES": str(args.flowchart_nodes),
+            }))
+            wait_ready(upstream + "/stats")
+            processes.append(spawn("main:app", args.proxy_port, {"MYMAP_BASE_URL": upstream, "API_MASTER_KEY": args.api_key}))
+            target = f"http://127.0.0.1:{args.proxy_port}"
+            wait_ready(target + "/v1/models")
+            args.pid = processes[-1].pid
+        result = asyncio.run(run_load(args, target))
+    finally:
+        for process in processes:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {"commit": git_commit(), "config": {k: v for k, v in vars(args).items() if k not in ("output", "api_key")}, "result": result}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,12 +3,13 @@ from contextlib import asynccontextmanager
 from typing import Optional
 
 from fastapi import FastAPI, Request, HTTPException, Depends, Header
-from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, StreamingResponse, HTMLResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.core.config import settings
+from app.core.metrics import registry
 from app.providers.mymap_provider import MyMapProvider
+from app.utils.static_assets import StaticAssetCache
 
 # --- 日志配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -16,6 +17,10 @@ logger = logging.getLogger(__name__)
 
 # --- 全局 Provider 实例 ---
 provider: Optional[MyMapProvider] = None
+static_assets = StaticAssetCache("static", max_age=settings.STATIC_MAX_AGE, reload_interval=settings.STATIC_RELOAD_INTERVAL)
+registry.register_collector("mymap_static_assets", "静态文件缓存统计 (files/bytes/hits/not_modified/reloads)", lambda: [
+    ({"stat": key}, value) for key, value in static_assets.stats().items()
+])
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -23,9 +28,11 @@ async def lifespan(app: FastAPI):
     logger.info(f"应用启动中... {settings.APP_NAME} v{settings.APP_VERSION}")
     provider = MyMapProvider()
     await provider.initialize()
+    await static_assets.start()
     logger.info(f"服务将在 http://localhost:{settings.NGINX_PORT} 上可用")
     logger.info(f"Web UI 测试界面已启用，请访问 http://localhost:{settings.NGINX_PORT}/")
     yield
+    await static_assets.close()
     await provider.close()
     logger.info("应用关闭。")
 
@@ -45,9 +52,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- 挂载静态文件目录 ---
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
 # --- 安全依赖 ---
 async def verify_api_key(authorization: Optional[str] = Header(None)):
     if settings.API_MASTER_KEY and settings.API_MASTER_KEY != "1":
@@ -64,6 +68,9 @@ async def chat_completions(request: Request):
         # 核心修正：同时传递 request 对象和解析后的 request_data
         request_data = await request.json()
         return await provider.chat_completion(request, request_data)
+    except HTTPException:
+        # 如准入控制的 429，原样返回状态码与 Retry-After
+        raise
     except Exception as e:
         logger.error(f"处理聊天请求时发生顶层错误: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"内部服务器错误: {str(e)}")
@@ -72,11 +79,23 @@ async def chat_completions(request: Request):
 async def list_models():
     return await provider.get_models()
 
+@app.get("/metrics", dependencies=[Depends(verify_api_key)], response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    # Prometheus 文本格式；多 worker 部署时每个 worker 各自统计
+    return PlainTextResponse(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # --- Web UI 路由 ---
-@app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def serve_ui():
-    try:
-        with open("static/index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
+# 文件在启动时已读入内存并预压缩，请求时不访问磁盘
+@app.api_route("/", methods=["GET", "HEAD"], response_class=HTMLResponse, include_in_schema=False)
+async def serve_ui(request: Request):
+    response = static_assets.response("index.html", request.headers)
+    if response is None:
         raise HTTPException(status_code=404, detail="UI 文件 (static/index.html) 未找到。")
+    return response
+
+@app.api_route("/static/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def serve_static(path: str, request: Request):
+    response = static_assets.response(path, request.headers)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return response